@@ -1,34 +1,152 @@
+import os
+import tempfile
 import numpy as np
 import matplotlib.pyplot as plt
+import matplotlib.ticker as ticker
 from calibrator import Calibrator
-from utils import remove_cosmic_ray, smooth, FileReader
+from utils import remove_cosmic_ray, smooth, downsample, make_position_grid, accumulate_spectra, FileReader, write_header, write_map, save_npz
+from cache import FileCache, CalibrationCache
+from parallel import RowExecutor
+from peakfit import fit_peaks, parameter_names
+from profiler import profile
+
+
+def get_map_bytes(calibrator, *args, **kwargs) -> int:
+    return calibrator.map_data.nbytes + calibrator.map_data_accumulated.nbytes
 
 
 class RayleighCalibrator(Calibrator):
-    def __init__(self, *args, **kwargs):
+    center_list = [500, 630, 760]
+    # 積算したスペクトル(map_data_accumulated)の処理の仕方
+    # separate: 積算前と積算後をそれぞれ処理する(積算前に処理してから積算した場合とは少し異なる)
+    # derived: 積算前だけを処理し，読み込み時と同じ和で積算し直す．積算後の分のCRRとSmoothを省ける
+    # accumulated: 積算後だけを処理する．最も速いが，積算前のスペクトルは処理されないので保存できない
+    accumulated_modes = ['separate', 'derived', 'accumulated']
+
+    def __init__(self, *args, cache: FileCache = None, lazy: bool = False, calibration_cache: CalibrationCache = None,
+                 dtype: str = 'float64', accumulated_mode: str = 'separate', **kwargs):
         super().__init__(*args, **kwargs)
         self.center: float = 630
         self.wavelength_range = 134
-        self.reader_raw = FileReader()
-        self.reader_bg = FileReader()
-        self.reader_ref = FileReader()
+        self.cache = cache
+        # 同じ参照ファイル・設定の校正結果を使い回す(calibrate_reference)
+        self.calibration_cache = calibration_cache
+        # 直前の校正がキャッシュから読み込んだものかどうか．Trueの場合フィットの詳細はない
+        self.calibration_reused: bool = False
+        self.reader_raw = FileReader(cache)
+        self.reader_bg = FileReader(cache)
+        self.reader_ref = FileReader(cache)
+        # lazyの場合，生データはメモリマップのまま扱い，処理は使い回す作業用バッファ上で行う
+        self.lazy: bool = False
+        self.set_lazy(lazy)
+        # マップのスペクトルを保持・処理する型(set_dtype)
+        self.dtype: str = 'float64'
+        self.set_dtype(dtype)
+        self.accumulated_mode: str = 'separate'
+        self.set_accumulated_mode(accumulated_mode)
+        # 作業用バッファを行ごとに分けて処理する際の行数
+        self.chunk_size: int = 1024
+        # CRR・Smooth・全位置のピークフィットを並列に処理する場合に設定する(set_executor)
+        self.executor: RowExecutor = None
 
         self.map_data: np.ndarray = None
         self.map_data_accumulated: np.ndarray = None
         self.bg_data_accumulated_smoothed: np.ndarray = None
         self.data_length: int = 0
 
+        # 処理のパラメータ
+        self.crr_width: int = 3
+        self.crr_threshold: float = 7
+        self.smooth_width: int = 100
+        # BG -> CRR -> Smoothの各段階の結果．キーはその段階までの(処理名, パラメータ)のタプル
+        self.stage_cache: dict = {}
+        # 各段階の結果を書き込む(map_data, map_data_accumulated)．段階の深さごとにひとつで，読み込み直しても使い回す
+        self.stage_buffers: dict = {}
+        # 現在のmap_dataに適用されている処理
+        self.pipeline_key: tuple = ()
+
+        # マップの画像(imshowで使い回す)
+        self.image = None
+        self.max_yticks: int = 50
+        # XY表示用の，位置から格子点への対応(get_position_grid)
+        self.position_grid: dict = None
+        # 処理後のデータの波長帯ごとの積分強度．キーは(処理, 画素の範囲)
+        self.band_intensity: dict = {}
+        # 全位置のピークフィットの結果．キーは(処理, 範囲, 関数)．値はパラメータ名ごとの位置ごとの値
+        self.fit_cache: dict = {}
+        # 最後にフィットした結果と，そのfit_cacheのキー．処理や校正を変えると，今のデータでフィットした結果に差し替える
+        self.peak_parameters: dict = None
+        self.peak_key: tuple = None
+
         self.set_measurement('Rayleigh')
 
+    def set_lazy(self, lazy: bool):
+        # 次に読み込むマップから有効
+        if lazy and self.cache is None:
+            raise ValueError('Lazy loading requires a cache.')
+        self.lazy = lazy
+        self.reader_raw.lazy = lazy
+
+    def set_dtype(self, dtype: str):
+        # 次に読み込むマップから有効．float32ではメモリと読み書きの量が半分になる
+        # 積算・スムージングの和はfloat64で計算して最後に丸めるので，誤差は値の相対で6e-8程度(2**24までの整数は正確)
+        # BG・参照データは小さく，校正に使うので常にfloat64
+        if np.dtype(dtype) not in [np.float32, np.float64]:
+            raise ValueError(f'Unsupported dtype: {dtype}')
+        self.dtype = np.dtype(dtype).name
+        self.reader_raw.dtype = self.dtype
+
+    def set_accumulated_mode(self, mode: str):
+        # 次のprocessから有効．処理の結果はモードごとに別のものとして覚える(get_stages)
+        if mode not in self.accumulated_modes:
+            raise ValueError(f'Unknown accumulated mode: {mode}')
+        self.accumulated_mode = mode
+
     def load_raw(self, filename):
         self.reader_raw.load(filename)
+        self.stage_cache = {}
+        self.pipeline_key = ()
+        self.position_grid = None
+        self.band_intensity = {}
+        self.fit_cache = {}
+        self.peak_parameters = None
+        self.peak_key = None
         self.xdata = self.reader_raw.xdata.copy()
-        self.map_data = self.reader_raw.spectra.copy()
-        self.map_data_accumulated = self.reader_raw.spectra_accumulated.copy()
         self.data_length = self.reader_raw.spectra_accumulated.shape[0]
+        if self.lazy:
+            self.map_data = self.create_buffer(self.reader_raw.spectra)
+            self.map_data_accumulated = self.create_buffer(self.reader_raw.spectra_accumulated)
+        self.reset_map_data()
+
+    def create_buffer(self, data: np.ndarray) -> np.memmap:
+        # RAMに載らないマップ用の作業用バッファ．キャッシュと同じ場所の一時ファイル上に作り，閉じると消える
+        os.makedirs(self.cache.directory, exist_ok=True)
+        return np.memmap(tempfile.TemporaryFile(dir=self.cache.directory), dtype=data.dtype, mode='w+', shape=data.shape)
+
+    def copy_rowwise(self, src: np.ndarray, dst: np.ndarray):
+        for start in range(0, src.shape[0], self.chunk_size):
+            dst[start:start + self.chunk_size] = src[start:start + self.chunk_size]
+
+    def apply_rowwise(self, func, data: np.ndarray):
+        # chunk_size行ずつfunc(入力, 出力)で同じ配列に書き戻す．一時的なメモリはchunk_size行分で済む
+        for start in range(0, data.shape[0], self.chunk_size):
+            chunk = data[start:start + self.chunk_size]
+            func(chunk, chunk)
+        return data
+
+    def get_stage_buffers(self, depth: int) -> tuple:
+        # depth段階目の結果を書き込む配列．形と型が同じなら前回のものを使い回す
+        buffers = self.stage_buffers.get(depth)
+        shapes = [self.reader_raw.spectra.shape, self.reader_raw.spectra_accumulated.shape]
+        if buffers is None or [b.shape for b in buffers] != shapes or buffers[0].dtype != self.reader_raw.spectra.dtype:
+            buffers = tuple(np.empty(shape, dtype=self.reader_raw.spectra.dtype) for shape in shapes)
+            self.stage_buffers[depth] = buffers
+        return buffers
 
     def load_bg(self, filename):
         self.reader_bg.load(filename)
+        self.stage_cache = {}
+        self.band_intensity = {}
         if self.xdata is None:
             self.xdata = self.reader_bg.xdata
         # remove cosmic ray and smooth automatically
@@ -39,6 +157,142 @@ class RayleighCalibrator(Calibrator):
         spec_sum = self.reader_ref.spectra.sum(axis=0)
         self.set_data(self.reader_ref.xdata, spec_sum)
 
+    @profile()
+    def calibrate(self, *args, **kwargs):
+        return super().calibrate(*args, **kwargs)
+
+    def calibrate_reference(self, center: float, dimension: int, material: str, function: str, easy: bool) -> bool:
+        # 参照データで校正する．同じ参照ファイル・設定で校正したことがあれば，その結果を読み込むだけ
+        self.reset_ref_data()
+        self.set_initial_xdata(center)
+        self.set_dimension(dimension)
+        self.set_material(material)
+        self.set_function(function)
+        self.set_search_width(5)
+        self.calibration_reused = False
+        try:
+            if self.calibration_cache is None:
+                return self.calibrate(easy=easy)
+
+            key = self.calibration_cache.get_key(self.reader_ref.filename, center, material, dimension, function, easy)
+            cached = self.calibration_cache.load(key)
+            if cached is not None:
+                self.xdata, self.calibration_info = cached
+                self.calibration_reused = True
+                return True
+            if not self.calibrate(easy=easy):
+                return False
+            self.calibration_cache.save(key, self.xdata, self.calibration_info)
+            return True
+        finally:
+            # 波長軸が変わるので，フィットの結果も新しい軸でのものにする
+            self.update_peak_parameters()
+
+    def get_band_range(self, x1: float, x2: float) -> tuple:
+        # 現在の波長軸(校正後)でx1からx2の範囲にある画素の範囲
+        inside = np.flatnonzero((min(x1, x2) <= self.xdata) & (self.xdata <= max(x1, x2)))
+        if inside.size == 0:
+            raise ValueError(f'No data in the band: {x1} - {x2}')
+        return inside[0], inside[-1] + 1
+
+    def get_band_intensity(self, x1: float, x2: float) -> np.ndarray:
+        # 波長帯x1からx2の，処理後の積算したスペクトルの位置ごとの和
+        # 処理していなければ生データの和(FileReader.integrate_band)を使う．同じ処理・範囲は計算し直さない
+        start, stop = self.get_band_range(x1, x2)
+        if not self.pipeline_key:
+            return self.reader_raw.integrate_band(start, stop)
+        key = (self.pipeline_key, start, stop)
+        if key not in self.band_intensity:
+            self.band_intensity[key] = self.map_data_accumulated[:, start:stop].sum(axis=1)
+        return self.band_intensity[key]
+
+    def get_position_grid(self) -> dict:
+        if self.position_grid is None:
+            self.position_grid = make_position_grid(self.reader_raw.pos_arr_absolute_accumulated)
+        return self.position_grid
+
+    def get_index_at(self, x: float, y: float) -> int:
+        # XY表示で(x, y)にある格子点のスペクトルの番号．なければ-1
+        grid = self.get_position_grid()
+        col, row = np.rint((np.array([x, y]) - grid['origin']) / grid['step']).astype(int)
+        if not (0 <= row < grid['index'].shape[0] and 0 <= col < grid['index'].shape[1]):
+            return -1
+        return int(grid['index'][row, col])
+
+    def get_map_values(self, band: list, value: str = 'intensity') -> np.ndarray:
+        # XY表示する位置ごとの値．intensityは処理後のデータの波長帯bandの積分強度，それ以外は最後のピークフィットのパラメータ
+        if value == 'intensity':
+            return self.get_band_intensity(*band)
+        if self.peak_parameters is None:
+            raise ValueError('No fitting result.')
+        return self.peak_parameters[value]
+
+    def get_grid_image(self, values: np.ndarray) -> np.ndarray:
+        # 位置ごとの値を位置の格子に並べた画像．位置のない格子点はNaN
+        grid = self.get_position_grid()
+        image = np.full(grid['index'].shape, np.nan)
+        image[grid['row'], grid['col']] = values
+        return image
+
+    @profile(size=lambda self, band, *args, **kwargs: self.map_data_accumulated.nbytes)
+    def fit_peaks(self, band: list, function: str = 'Lorentzian', callback=None) -> dict:
+        # 処理後の全位置のスペクトルの，波長帯bandにあるピークをfunctionでフィットする
+        # 初期値は一括で求めた最大値の位置など．executorがあれば並列に処理する
+        # callback(終わった位置の数, 位置の数)はchunk_size個(並列の場合はすべてのプロセスに行き渡る数)ごとに呼ばれる．例外を投げれば途中でやめられる
+        start, stop = self.get_band_range(*band)
+        x = self.xdata[start:stop]
+        key = self.get_fit_key(start, stop, function)
+        if key not in self.fit_cache:
+            num_rows = self.map_data_accumulated.shape[0]
+            step = self.chunk_size
+            if self.executor is not None:
+                step = max(step, self.executor.chunk_size * self.executor.workers)
+            result = []
+            for row in range(0, num_rows, step):
+                if callback is not None:
+                    callback(row, num_rows)
+                spectra = np.ascontiguousarray(self.map_data_accumulated[row:row + step, start:stop])
+                if self.executor is None:
+                    result.append(fit_peaks(spectra, x, function))
+                else:
+                    result.append(self.executor.map_chunks(fit_peaks, spectra, x=x, function=function))
+            result = np.concatenate(result) if result else fit_peaks(np.empty([0, stop - start]), x, function)
+            self.fit_cache[key] = dict(zip(parameter_names + ['rms'], result.T))
+        self.peak_key = (start, stop, function)
+        self.peak_parameters = self.fit_cache[key]
+        return self.peak_parameters
+
+    def get_fit_key(self, start: int, stop: int, function: str) -> tuple:
+        # 今の処理と波長軸でstartからstopの画素をフィットした結果のキー
+        return self.pipeline_key, start, stop, float(self.xdata[start]), float(self.xdata[stop - 1]), function
+
+    def update_peak_parameters(self):
+        # 処理や校正を変えた後，最後にフィットした範囲・関数の，今のデータでの結果にする．まだフィットしていなければNone
+        if self.peak_key is None:
+            return
+        start, stop, function = self.peak_key
+        if stop > self.xdata.shape[0]:
+            self.peak_parameters = None
+            return
+        self.peak_parameters = self.fit_cache.get(self.get_fit_key(start, stop, function))
+
+    def get_color_range(self) -> list:
+        # 読み込み時の要約から，マップ全体を走査せずに色の範囲を決める
+        summary = self.reader_raw.summary
+        return [summary['min'].min(), summary['max'].max()]
+
+    def guess_reference_settings(self, filename: str):
+        # ファイル名に含まれる物質名と中心波長を探す．見つからなければNone
+        material = None
+        for m in self.get_material_list():
+            if m in filename:
+                material = m
+        center = None
+        for c in self.center_list:
+            if str(c) in filename:
+                center = float(c)
+        return material, center
+
     def set_initial_xdata(self, center: float):
         self.center = center
         self.xdata = np.linspace(center - self.wavelength_range / 2, center + self.wavelength_range / 2, self.reader_ref.xdata.shape[0])
@@ -46,8 +300,13 @@ class RayleighCalibrator(Calibrator):
     def reset_map_data(self):
         if self.reader_raw.spectra is not None:
             # for cosmic ray removal and background correction
-            self.map_data = self.reader_raw.spectra.copy()
-            self.map_data_accumulated = self.reader_raw.spectra_accumulated.copy()
+            if self.lazy:
+                self.copy_rowwise(self.reader_raw.spectra, self.map_data)
+                self.copy_rowwise(self.reader_raw.spectra_accumulated, self.map_data_accumulated)
+            else:
+                # 各段階は入力を書き換えないので，生データをそのまま使う
+                self.map_data = self.reader_raw.spectra
+                self.map_data_accumulated = self.reader_raw.spectra_accumulated
 
     def reset_ref_data(self):
         if self.reader_ref.spectra is not None:
@@ -55,23 +314,168 @@ class RayleighCalibrator(Calibrator):
             spec_sum = self.reader_ref.spectra.sum(axis=0)
             self.set_data(self.reader_ref.xdata, spec_sum)
 
-    def correct_background(self):
+    def process_views(self, process_data, process_accumulated, out: tuple = None):
+        # accumulated_modeに応じて，map_dataとmap_data_accumulatedをprocess_*(入力, 出力)で処理する
+        out = (None, None) if out is None else out
+        if self.accumulated_mode != 'accumulated':
+            self.map_data = process_data(self.map_data, out[0])
+        if self.accumulated_mode == 'derived':
+            self.accumulate_map_data(out[1])
+        else:
+            self.map_data_accumulated = process_accumulated(self.map_data_accumulated, out[1])
+
+    def accumulate_map_data(self, out: np.ndarray = None):
+        # 処理したmap_dataから，読み込み時と同じ和で積算したスペクトルを作り直す
+        if self.lazy:
+            out = self.map_data_accumulated
+        self.map_data_accumulated = accumulate_spectra(self.map_data, self.reader_raw.accumulation, out,
+                                                       max(1, self.chunk_size // self.reader_raw.accumulation))
+
+    def subtract(self, data: np.ndarray, bg: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+        if self.lazy:
+            data -= bg
+            return data
+        # 前段の結果をキャッシュしているので，元の配列は書き換えずout(指定がなければ新しい配列)に書き込む
+        # 結果はマップと同じ型にする(lazyの場合と同じく，float64で計算してから丸める)
+        return np.subtract(data, bg, out=np.empty_like(data) if out is None else out)
+
+    @profile(size=get_map_bytes)
+    def correct_background(self, out: tuple = None):
         if self.bg_data_accumulated_smoothed is None:
             raise ValueError('No background data.')
-        self.map_data -= self.bg_data_accumulated_smoothed / self.reader_bg.accumulation
-        self.map_data_accumulated -= self.bg_data_accumulated_smoothed
+        bg = self.bg_data_accumulated_smoothed
+        self.process_views(lambda data, o: self.subtract(data, bg / self.reader_bg.accumulation, o),
+                           lambda data, o: self.subtract(data, bg, o), out)
 
-    def remove_cosmic_ray(self):
-        self.map_data = remove_cosmic_ray(self.map_data)
-        self.map_data_accumulated = remove_cosmic_ray(self.map_data_accumulated)
+    def set_executor(self, workers: int = None, chunk_size: int = 256):
+        # CRR・Smooth・全位置のピークフィットをプロセスプールで並列に処理する．workersに0を指定すると並列処理をやめる
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        if workers != 0:
+            self.executor = RowExecutor(workers, chunk_size)
 
-    def smooth(self):
-        self.map_data = smooth(self.map_data, 100)
-        self.map_data_accumulated = smooth(self.map_data_accumulated, 100)
+    def map_rows(self, func, data: np.ndarray, out: np.ndarray = None, **kwargs) -> np.ndarray:
+        # 行ごとに独立な処理funcを適用してoutに書き込む．executorがあれば並列に，lazyなら作業用バッファに書き戻す
+        if self.executor is None:
+            apply = lambda d, o: func(d, out=o, **kwargs)
+        else:
+            apply = lambda d, o: self.executor.map_rows(func, d, out=o, **kwargs)
+        if self.lazy:
+            return self.apply_rowwise(apply, data)
+        return apply(data, out)
 
+    @profile(size=get_map_bytes)
+    def remove_cosmic_ray(self, out: tuple = None):
+        apply = lambda data, o: self.map_rows(remove_cosmic_ray, data, o, width=self.crr_width, threshold=self.crr_threshold)
+        self.process_views(apply, apply, out)
+
+    @profile(size=get_map_bytes)
+    def smooth(self, out: tuple = None):
+        apply = lambda data, o: self.map_rows(smooth, data, o, width=self.smooth_width)
+        self.process_views(apply, apply, out)
+
+    def get_stages(self, background: bool, cosmic_ray: bool, smoothing: bool) -> tuple:
+        stages = []
+        if background:
+            stages.append(('correct_background', self.reader_bg.filename, self.accumulated_mode))
+        if cosmic_ray:
+            stages.append(('remove_cosmic_ray', self.crr_width, self.crr_threshold, self.accumulated_mode))
+        if smoothing:
+            stages.append(('smooth', self.smooth_width, self.accumulated_mode))
+        return tuple(stages)
+
+    def check_map_data(self) -> None:
+        # accumulatedモードで処理した場合，積算前のスペクトルは処理されていない
+        if any(stage[-1] == 'accumulated' for stage in self.pipeline_key):
+            raise ValueError('Spectra before accumulation are not processed in the accumulated mode.')
+
+    @profile()
+    def process(self, background: bool = False, cosmic_ray: bool = False, smoothing: bool = False, callback=None):
+        # BG -> CRR -> Smoothの順に処理する
+        # 設定が変わっていない前段の結果は使い回し，変わった段階以降だけを計算し直す
+        # callback(何段階目か, 段階数, 処理名)は各段階の前に呼ばれる．例外を投げれば途中でやめられる
+        stages = self.get_stages(background, cosmic_ray, smoothing)
+        num_done = 0
+        # lazyの場合，作業用バッファはひとつしかないので，毎回生データから処理し直す
+        self.reset_map_data()
+        if not self.lazy:
+            for i in range(len(stages), 0, -1):
+                if stages[:i] in self.stage_cache:
+                    num_done = i
+                    self.map_data, self.map_data_accumulated = self.stage_cache[stages[:i]]
+                    break
+            # 今回の処理の前段にあたらない結果は捨てる
+            self.stage_cache = {key: value for key, value in self.stage_cache.items() if stages[:len(key)] == key}
+
+        self.pipeline_key = stages[:num_done]
+        try:
+            for i in range(num_done, len(stages)):
+                if callback is not None:
+                    callback(i, len(stages), stages[i][0])
+                if self.lazy:
+                    getattr(self, stages[i][0])()
+                else:
+                    # 残っているキャッシュは今回の前段だけなので，同じ深さのバッファに上書きしてよい
+                    getattr(self, stages[i][0])(out=self.get_stage_buffers(i))
+                    self.stage_cache[stages[:i + 1]] = (self.map_data, self.map_data_accumulated)
+                self.pipeline_key = stages[:i + 1]
+        finally:
+            # 途中で取り消された場合も，フィットの結果はそこまで処理したデータのものにする
+            self.update_peak_parameters()
+
+    def get_header(self) -> dict:
+        # 書き出すデータのメタデータ．BGはバックグラウンド補正をかけた場合のみ
+        background_corrected = any(stage[0] == 'correct_background' for stage in self.pipeline_key)
+        return {
+            'abs_path_raw': self.reader_raw.filename,
+            'abs_path_bg': self.reader_bg.filename if background_corrected else '',
+            'abs_path_ref': self.reader_ref.filename,
+            'calibration': self.calibration_info,
+            'time': self.reader_raw.time,
+            'integration': self.reader_raw.integration,
+            'accumulation': self.reader_raw.accumulation,
+            'interval': self.reader_raw.interval,
+            'num_pos': self.reader_raw.num_pos,
+        }
+
+    @profile(size=lambda self, filename, index=None: os.path.getsize(filename))
+    def save(self, filename: str, index: int = None):
+        # indexを指定した場合はその位置のスペクトルのみ保存．拡張子が.npzの場合はバイナリで保存
+        self.check_map_data()
+        if index is None:
+            map_data = self.map_data
+            pos_arr = self.reader_raw.pos_arr
+        else:
+            i1 = index * self.reader_raw.accumulation
+            i2 = (index + 1) * self.reader_raw.accumulation
+            map_data = self.map_data[i1:i2]
+            pos_arr = self.reader_raw.pos_arr[i1:i2]
+        if filename.endswith('.npz'):
+            save_npz(filename, self.xdata, map_data, pos_arr, self.get_header())
+            return
+        with open(filename, 'w') as f:
+            write_header(f, self.get_header())
+            write_map(f, self.xdata, map_data, pos_arr)
+
+    @profile()
     def imshow(self, ax: plt.Axes, color_range: list, cmap: str, ev=False) -> None:
-        mesh = ax.pcolormesh(self.map_data_accumulated, cmap=cmap)
-        mesh.set_clim(*color_range)
+        # マップはひとつの画像として一度だけ作り，以降はデータ・カラーマップ・範囲のみ更新する
+        # 画面の画素数より大きいマップは，ブロックごとの平均で縮小して表示する
+        num_rows, num_pixel = self.map_data_accumulated.shape
+        bbox = ax.get_window_extent()
+        data = downsample(self.map_data_accumulated, max(int(bbox.height), 1), max(int(bbox.width), 1))
+        extent = (0, num_pixel, 0, num_rows)  # pcolormeshと同じく，i番目のスペクトルがy = iからi + 1に表示される
+        if self.image is None or self.image.axes is not ax:
+            self.image = ax.imshow(data, aspect='auto', origin='lower', interpolation='nearest', extent=extent)
+        else:
+            self.image.set_data(data)
+            self.image.set_extent(extent)
+        self.image.set_cmap(cmap)
+        self.image.set_clim(*color_range)
+        ax.set_aspect('auto')
+        ax.set_xlim(0, num_pixel)
+        ax.set_ylim(0, num_rows)
 
         xtick = np.arange(0, self.xdata.shape[0], 128)
         ax.set_xticks(xtick)
@@ -79,5 +483,29 @@ class RayleighCalibrator(Calibrator):
         if ev:
             label = 1240 / label
         ax.set_xticklabels(np.round(label))
-        ax.set_yticks(range(self.map_data_accumulated.shape[0]))
-        ax.set_yticklabels(map(lambda x: round(np.linalg.norm(x)), self.reader_raw.pos_arr_relative_accumulated))
+        # 目盛りが多すぎると描画が遅くなるので，max_yticks個程度に間引く
+        step = max(1, int(np.ceil(num_rows / self.max_yticks)))
+        ax.set_yticks(range(0, num_rows, step))
+        ax.set_yticklabels(map(lambda x: round(np.linalg.norm(x)), self.reader_raw.pos_arr_relative_accumulated[::step]))
+
+    @profile()
+    def imshow_xy(self, ax: plt.Axes, values: np.ndarray, color_range: list, cmap: str) -> None:
+        # 位置ごとの値(get_map_values)を位置の座標どおりに並べた画像．imshowと同じ画像を使い回す
+        grid = self.get_position_grid()
+        image = self.get_grid_image(values)
+        (x0, y0), (dx, dy) = grid['origin'], grid['step']
+        extent = (x0 - dx / 2, x0 + (image.shape[1] - 0.5) * dx, y0 - dy / 2, y0 + (image.shape[0] - 0.5) * dy)
+        if self.image is None or self.image.axes is not ax:
+            self.image = ax.imshow(image, aspect='equal', origin='lower', interpolation='nearest', extent=extent)
+        else:
+            self.image.set_data(image)
+            self.image.set_extent(extent)
+        self.image.set_cmap(cmap)
+        self.image.set_clim(*color_range)
+        ax.set_aspect('equal')
+        ax.set_xlim(extent[:2])
+        ax.set_ylim(extent[2:])
+        # imshowで固定した目盛りを自動に戻す
+        for axis in [ax.xaxis, ax.yaxis]:
+            axis.set_major_locator(ticker.AutoLocator())
+            axis.set_major_formatter(ticker.ScalarFormatter())
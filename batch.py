@@ -0,0 +1,188 @@
+import os
+import csv
+import sys
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import matplotlib
+matplotlib.use('Agg')  # GUIなしで動かすため，tkinterを読み込まないバックエンドにする
+import numpy as np
+import matplotlib.pyplot as plt
+from RayleighCalibrator import RayleighCalibrator
+from cache import FileCache, CalibrationCache
+from stitch import stitch_files
+
+
+def calibrate(calibrator: RayleighCalibrator, job: dict) -> None:
+    # MainWindow.calibrateと同じ手順．指定がなければファイル名から物質名と中心波長を推定する
+    # 同じ参照ファイル・設定の校正結果がキャッシュにあれば使い回す
+    material, center = calibrator.guess_reference_settings(job['ref'])
+    ok = calibrator.calibrate_reference(
+        center=job['center'] or center or calibrator.center,
+        dimension=int(job['dimension'] or calibrator.get_dimension_list()[0][0]),
+        material=job['material'] or material or calibrator.get_material_list()[0],
+        function=job['function'] or calibrator.get_function_list()[0],
+        easy=job['easy'])
+    if not ok:
+        raise ValueError(f'Peaks not found: {job["ref"]}')
+
+
+def save_preview(calibrator: RayleighCalibrator, filename: str) -> None:
+    # 積算したマップをGUIと同じ表示でPNGに保存する．色の範囲は処理後のデータの1-99パーセンタイル
+    fig, ax = plt.subplots(figsize=(6, 6))
+    try:
+        calibrator.imshow(ax, list(np.nanpercentile(calibrator.map_data_accumulated, [1, 99])), 'hot')
+        ax.set_title(os.path.basename(calibrator.reader_raw.filename))
+        fig.savefig(filename)
+    finally:
+        plt.close(fig)
+        calibrator.image = None
+
+
+def process_job(job: dict) -> str:
+    # ひとつのマップを calibrate -> BG -> CRR -> Smooth の順に処理して保存し，保存先を返す
+    calibrator = RayleighCalibrator(cache=FileCache() if job['cache'] else None,
+                                    calibration_cache=CalibrationCache() if job['cache'] else None,
+                                    dtype=job['dtype'], accumulated_mode=job['accumulated_mode'])
+    if job['row_workers'] > 1:
+        calibrator.set_executor(job['row_workers'], job['chunk_size'])
+    try:
+        calibrator.load_raw(job['raw'])
+        if job['bg']:
+            calibrator.load_bg(job['bg'])
+        if job['ref']:
+            calibrator.load_ref(job['ref'])
+            calibrate(calibrator, job)
+        if job['background'] and not job['bg']:
+            raise ValueError(f'No background data: {job["raw"]}')
+        calibrator.process(background=job['background'], cosmic_ray=job['cosmic_ray'], smoothing=job['smoothing'])
+
+        os.makedirs(job['output'], exist_ok=True)
+        name = os.path.splitext(os.path.basename(job['raw']))[0]
+        filename = os.path.join(job['output'], f'{name}{job["suffix"]}.{job["format"]}')
+        calibrator.save(filename)
+        if job['preview']:
+            save_preview(calibrator, os.path.join(job['output'], f'{name}{job["suffix"]}.png'))
+    finally:
+        calibrator.set_executor(0)
+    return filename
+
+
+def read_manifest(filename: str) -> list:
+    # 1行1マップのCSV．raw列は必須，bg, ref, center, material列は省略可
+    with open(filename, 'r', newline='') as f:
+        rows = list(csv.DictReader(f))
+    for row in rows:
+        if not row.get('raw'):
+            raise ValueError(f'Column "raw" is required: {filename}')
+    return rows
+
+
+def make_job(row: dict, args: argparse.Namespace) -> dict:
+    # rowのbg, ref, center, materialはコマンドラインの指定より優先する
+    center = row.get('center') or args.center
+    return {
+        'raw': row['raw'],
+        'bg': row.get('bg') or args.bg,
+        'ref': row.get('ref') or args.ref,
+        'center': float(center) if center else None,
+        'material': row.get('material') or args.material,
+        'dimension': args.dimension,
+        'function': args.function,
+        'easy': not args.fit,
+        'background': args.background,
+        'cosmic_ray': args.cosmic_ray,
+        'smoothing': args.smooth,
+        'output': args.output,
+        'suffix': args.suffix,
+        'format': args.format,
+        'cache': not args.no_cache,
+        'row_workers': args.row_workers,
+        'chunk_size': args.chunk_size,
+        'dtype': args.dtype,
+        'accumulated_mode': args.accumulated_mode,
+        'preview': args.preview,
+    }
+
+
+def make_jobs(args: argparse.Namespace) -> list:
+    rows = [{'raw': raw} for raw in args.raw]
+    if args.manifest is not None:
+        rows += read_manifest(args.manifest)
+    return [make_job(row, args) for row in rows]
+
+
+def run(jobs: list, workers: int = 1) -> list:
+    # 保存したファイル名をjobsと同じ順に返す(失敗したマップはNone)．workersが2以上ならファイルごとにプロセスを分けて並列に処理する
+    outputs = [None] * len(jobs)
+    if workers <= 1:
+        for i, job in enumerate(jobs):
+            try:
+                outputs[i] = process_job(job)
+                print(f'{job["raw"]} -> {outputs[i]}')
+            except Exception as e:
+                print(f'{job["raw"]}: {e}', file=sys.stderr)
+        return outputs
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(process_job, job): i for i, job in enumerate(jobs)}
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                outputs[i] = future.result()
+                print(f'{jobs[i]["raw"]} -> {outputs[i]}')
+            except Exception as e:
+                print(f'{jobs[i]["raw"]}: {e}', file=sys.stderr)
+    return outputs
+
+
+def add_job_arguments(parser: argparse.ArgumentParser) -> None:
+    # make_jobで使う，マップごとの処理の設定(watch.pyと共通)
+    parser.add_argument('--bg', help='background file used for every map')
+    parser.add_argument('--ref', help='reference file used for every map')
+    parser.add_argument('--center', type=float, help='center wavelength [nm] (guessed from the reference file name)')
+    parser.add_argument('--material', help='reference material (guessed from the reference file name)')
+    parser.add_argument('--dimension', type=int, help='dimension of the calibration function')
+    parser.add_argument('--function', help='peak function used with --fit')
+    parser.add_argument('--fit', action='store_true', help='fit peaks instead of taking the maxima')
+    parser.add_argument('--background', action='store_true', help='background correction')
+    parser.add_argument('--cosmic-ray', action='store_true', help='cosmic ray removal')
+    parser.add_argument('--smooth', action='store_true', help='smoothing')
+    parser.add_argument('--output', default='.', help='output folder')
+    parser.add_argument('--suffix', default='_processed', help='suffix of the output file names')
+    parser.add_argument('--format', choices=['txt', 'npz'], default='txt')
+    parser.add_argument('--preview', action='store_true', help='also save a PNG image of each processed map')
+    parser.add_argument('--row-workers', type=int, default=1, help='number of processes for CRR and smoothing of each map')
+    parser.add_argument('--chunk-size', type=int, default=256, help='number of spectra per task with --row-workers')
+    parser.add_argument('--dtype', choices=['float64', 'float32'], default='float64',
+                        help='type of the map data (float32 halves memory, about 7 significant digits)')
+    parser.add_argument('--accumulated-mode', choices=['separate', 'derived'], default='derived',
+                        help='how the accumulated spectra are processed. They are not saved, so "derived" '
+                             '(process each acquisition and sum them again) gives the same output faster')
+    parser.add_argument('--no-cache', action='store_true', help='do not use the binary file and calibration caches')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Calibrate and process RAS map files without the GUI.')
+    parser.add_argument('raw', nargs='*', help='raw map files')
+    parser.add_argument('--manifest', help='CSV file with columns raw, bg, ref, center, material')
+    add_job_arguments(parser)
+    parser.add_argument('--workers', type=int, default=1, help='number of processes (one map per process)')
+    parser.add_argument('--stitch', help='also stitch all processed maps (e.g. 500/630/760 nm windows) into this file')
+    parser.add_argument('--stitch-mode', choices=['blend', 'crop'], default='blend', help='how to merge overlapping windows')
+    args = parser.parse_args()
+
+    jobs = make_jobs(args)
+    if not jobs:
+        parser.error('No raw files.')
+    outputs = run(jobs, args.workers)
+    if None in outputs:
+        sys.exit(1)
+    if args.stitch is not None:
+        # 各ファイルを作った処理の設定も結果を使い回す条件に含める
+        pipeline_key = (args.background, args.cosmic_ray, args.smooth, args.dtype, args.accumulated_mode)
+        stitch_files(outputs, args.stitch, args.stitch_mode, pipeline_key=pipeline_key)
+        print(f'{", ".join(outputs)} -> {args.stitch}')
+
+
+if __name__ == '__main__':
+    main()
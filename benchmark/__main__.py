@@ -0,0 +1,42 @@
+import sys
+import json
+import argparse
+import matplotlib
+matplotlib.use('Agg')  # GUIなしで動かすため，tkinterを読み込まないバックエンドにする
+from benchmark.suite import run_suite
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark loading, processing and exporting synthetic RAS maps.')
+    parser.add_argument('--num-pos', type=int, default=100, help='number of positions')
+    parser.add_argument('--num-pixel', type=int, default=1024, help='number of pixels per spectrum')
+    parser.add_argument('--accumulation', type=int, default=3, help='number of spectra per position')
+    parser.add_argument('--spikes', type=int, default=10, help='number of injected cosmic ray spikes')
+    parser.add_argument('--version', type=int, choices=[1, 2], default=2, help='RAS header format')
+    parser.add_argument('--repeat', type=int, default=3, help='number of timed runs per stage (the fastest is reported)')
+    parser.add_argument('--lazy', action='store_true', help='process on memory-mapped buffers')
+    parser.add_argument('--dtype', choices=['float64', 'float32'], default='float64', help='type of the map data')
+    parser.add_argument('--accumulated-mode', choices=['separate', 'derived', 'accumulated'], default='separate',
+                        help='how the accumulated spectra are processed')
+    parser.add_argument('--row-workers', type=int, default=1, help='number of processes for CRR and smoothing')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--tmp', help='folder for the generated files (default: system temp folder)')
+    parser.add_argument('--output', help='JSON file to write the results to (default: stdout)')
+    args = parser.parse_args()
+
+    result = run_suite(args.num_pos, args.num_pixel, args.accumulation, args.spikes, args.version,
+                       args.repeat, args.lazy, args.row_workers, args.seed, args.tmp, args.dtype,
+                       args.accumulated_mode)
+    if args.output is None:
+        json.dump(result, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+    if not result['crr_parity']['identical']:
+        print('Cosmic ray removal differs from the reference implementation.', file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
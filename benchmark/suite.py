@@ -0,0 +1,138 @@
+import os
+import sys
+import time
+import platform
+import tempfile
+import tracemalloc
+import numpy as np
+from utils import FileReader, remove_cosmic_ray, remove_cosmic_ray_1d
+from cache import FileCache
+from RayleighCalibrator import RayleighCalibrator
+from benchmark.synthetic import generate_map, write_ras
+
+
+def measure(func, setup=None, repeat: int = 3) -> dict:
+    # 時間はrepeat回のうち最短のもの．メモリのピークはtracemallocで別にもう一回実行して測る
+    # (tracemallocを有効にすると遅くなるので，時間の計測とは分ける)
+    seconds = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        seconds.append(time.perf_counter() - start)
+
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    try:
+        func()
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {'seconds': min(seconds), 'seconds_all': seconds, 'peak_bytes': peak_bytes}
+
+
+def add_throughput(result: dict, num_spectra: int, num_bytes: int = None) -> dict:
+    seconds = max(result['seconds'], 1e-12)
+    result['spectra_per_second'] = num_spectra / seconds
+    if num_bytes is not None:
+        result['megabytes_per_second'] = num_bytes / seconds / 1024 ** 2
+    return result
+
+
+def check_cosmic_ray_parity(spectra: np.ndarray, max_spectra: int = 100, width: int = 3, threshold: float = 7) -> dict:
+    # 一括処理のCRRが，元の1スペクトルずつの実装と完全に一致するか確かめる(遅いので先頭max_spectra本のみ)
+    spectra = spectra[:max_spectra]
+    expected = np.array([remove_cosmic_ray_1d(s, width, threshold) for s in spectra])
+    actual = remove_cosmic_ray(spectra, width, threshold)
+    return {
+        'num_spectra': spectra.shape[0],
+        'identical': bool(np.array_equal(expected, actual)),
+        'max_abs_difference': float(np.abs(expected - actual).max()) if spectra.size else 0.0,
+    }
+
+
+def get_environment() -> dict:
+    return {
+        'python': sys.version.split()[0],
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+def run_suite(num_pos: int = 100, num_pixel: int = 1024, accumulation: int = 3, num_spikes: int = 10,
+              version: int = 2, repeat: int = 3, lazy: bool = False, row_workers: int = 1, seed: int = 0,
+              directory: str = None, dtype: str = 'float64', accumulated_mode: str = 'separate') -> dict:
+    # 擬似データを作り，読み込みから書き出しまでの各段階の時間・スループット・メモリのピークを測る
+    with tempfile.TemporaryDirectory(dir=directory) as tmp:
+        filename_raw = os.path.join(tmp, 'raw.txt')
+        filename_bg = os.path.join(tmp, 'bg.txt')
+        xdata, spectra, pos_arr, spikes = generate_map(num_pos, num_pixel, accumulation, num_spikes, seed=seed)
+        write_ras(filename_raw, xdata, spectra, pos_arr, accumulation, version)
+        xdata_bg, spectra_bg, pos_arr_bg, _ = generate_map(1, num_pixel, accumulation, 0, peak_height=0, seed=seed + 1)
+        write_ras(filename_bg, xdata_bg, spectra_bg, pos_arr_bg, accumulation, version)
+        file_bytes = os.path.getsize(filename_raw)
+        num_spectra = spectra.shape[0]
+        cache = FileCache(os.path.join(tmp, 'cache'))
+
+        stages = {}
+        stages['load'] = add_throughput(measure(lambda: FileReader(dtype=dtype).load(filename_raw), repeat=repeat), num_spectra, file_bytes)
+        stages['load_cache_miss'] = add_throughput(
+            measure(lambda: FileReader(cache, dtype=dtype).load(filename_raw), setup=cache.clear, repeat=repeat), num_spectra, file_bytes)
+        stages['load_cache_hit'] = add_throughput(
+            measure(lambda: FileReader(cache, dtype=dtype).load(filename_raw), repeat=repeat), num_spectra, file_bytes)
+        stages['load_lazy'] = add_throughput(
+            measure(lambda: FileReader(cache, lazy=True, dtype=dtype).load(filename_raw), setup=cache.clear, repeat=repeat),
+            num_spectra, file_bytes)
+
+        reader = FileReader(dtype=dtype)
+        reader.load(filename_raw)
+        stages['accumulate'] = add_throughput(measure(reader.accumulate, repeat=repeat), num_spectra)
+
+        # 処理はGUIと同じくRayleighCalibratorの各段階を，毎回生データに戻してから測る
+        calibrator = RayleighCalibrator(cache=cache, lazy=lazy, dtype=dtype, accumulated_mode=accumulated_mode)
+        if row_workers > 1:
+            calibrator.set_executor(row_workers)
+        try:
+            calibrator.load_raw(filename_raw)
+            calibrator.load_bg(filename_bg)
+            for name in ['correct_background', 'remove_cosmic_ray', 'smooth']:
+                # processと同じく，確保済みのバッファに書き込む
+                stage = getattr(calibrator, name)
+                stages[name] = add_throughput(
+                    measure(lambda: stage(out=calibrator.get_stage_buffers(0)), setup=calibrator.reset_map_data,
+                            repeat=repeat), num_spectra)
+
+            calibrator.reset_map_data()
+            for extension in ['txt', 'npz']:
+                filename_save = os.path.join(tmp, f'processed.{extension}')
+                result = measure(lambda: calibrator.save(filename_save), repeat=repeat)
+                stages[f'save_{extension}'] = add_throughput(result, num_spectra, os.path.getsize(filename_save))
+        finally:
+            calibrator.set_executor(0)
+
+        crr_parity = check_cosmic_ray_parity(reader.spectra)
+
+    return {
+        'config': {
+            'num_pos': num_pos,
+            'num_pixel': num_pixel,
+            'accumulation': accumulation,
+            'num_spectra': num_spectra,
+            'num_spikes': num_spikes,
+            'version': version,
+            'repeat': repeat,
+            'lazy': lazy,
+            'dtype': dtype,
+            'accumulated_mode': accumulated_mode,
+            'row_workers': row_workers,
+            'seed': seed,
+            'file_bytes': file_bytes,
+        },
+        'environment': get_environment(),
+        'stages': stages,
+        'crr_parity': crr_parity,
+    }
@@ -0,0 +1,45 @@
+import numpy as np
+from utils import write_map
+
+
+def generate_map(num_pos: int = 100, num_pixel: int = 1024, accumulation: int = 3, num_spikes: int = 10,
+                 center: float = 630, wavelength_range: float = 134, peak_height: float = 2000, seed: int = 0):
+    # 擬似的なマップ．ベースライン + ローレンツ型のピーク + ポアソンノイズに，宇宙線のスパイクをnum_spikes個加える
+    # 積算するaccumulation本のスペクトルは同じ位置で取ったことにする
+    rng = np.random.default_rng(seed)
+    num_spectra = num_pos * accumulation
+    xdata = np.linspace(center - wavelength_range / 2, center + wavelength_range / 2, num_pixel)
+    pos_arr = np.repeat(rng.uniform(0, 100, [num_pos, 3]).round(2), accumulation, axis=0)
+
+    # ピークの位置と高さは位置ごとに少しずつ変える
+    peak_center = np.repeat(rng.normal(center, 1, num_pos), accumulation)
+    height = np.repeat(rng.uniform(0.5, 1, num_pos) * peak_height, accumulation)
+    lorentz = height[:, np.newaxis] / (1 + ((xdata - peak_center[:, np.newaxis]) / 2) ** 2)
+    spectra = rng.poisson(500 + lorentz).astype(float)
+
+    # スパイクは1画素だけの大きな値
+    spikes = np.stack([rng.integers(0, num_spectra, num_spikes), rng.integers(0, num_pixel, num_spikes)], axis=1)
+    spectra[spikes[:, 0], spikes[:, 1]] += rng.uniform(5000, 20000, num_spikes).round()
+    return xdata, spectra, pos_arr, spikes
+
+
+def write_ras(filename: str, xdata: np.ndarray, spectra: np.ndarray, pos_arr: np.ndarray, accumulation: int,
+              version: int = 2, integration: float = 1.0, interval: float = 0.5, time: str = '2023-05-11 12:00:00'):
+    # RASと同じ形式で書き出す．intervalとnum_posの書式がバージョンによって異なる(process_interval_and_num_pos)
+    # v1: "# interval: True 0.5"，v2: "# interval: 0.5"
+    num_pos = spectra.shape[0] // accumulation
+    if version == 1:
+        interval_str = f'True {interval}'
+        num_pos_str = f'False {num_pos}'
+    elif version == 2:
+        interval_str = f'{interval}'
+        num_pos_str = f'{num_pos}'
+    else:
+        raise ValueError(f'Unknown RAS version: {version}')
+    with open(filename, 'w') as f:
+        f.write(f'# time: {time}\n')
+        f.write(f'# integration: {integration}\n')
+        f.write(f'# accumulation: {accumulation}\n')
+        f.write(f'# interval: {interval_str}\n')
+        f.write(f'# num_pos: {num_pos_str}\n')
+        write_map(f, xdata, spectra, pos_arr)
@@ -0,0 +1,231 @@
+import os
+import json
+import shutil
+import pickle
+import hashlib
+import numpy as np
+
+
+CACHE_VERSION = 4
+# 校正結果の保存形式のバージョン．ファイルのキャッシュとは別に上げる
+CALIBRATION_CACHE_VERSION = 1
+
+
+def get_cache_directory():
+    return os.path.join(os.path.expanduser('~'), '.cache', 'RASCalibration')
+
+
+def get_entry_mtimes(directory: str) -> dict:
+    # 書き込み中でないエントリと最後に使った時刻．他のプロセスが同時に消したエントリは含めない
+    mtimes = {}
+    for e in os.scandir(directory):
+        if not e.is_dir() or '.tmp' in e.name:
+            continue
+        try:
+            mtimes[e.path] = os.path.getmtime(e.path)
+        except FileNotFoundError:
+            continue
+    return mtimes
+
+
+class FileCache:
+    # 読み込んだRASファイルの配列をバイナリ(.npy)で保存しておき，次回はメモリマップで開く
+    # エントリはパスごとにひとつで，更新時刻とサイズが一致する場合のみ使う
+    def __init__(self, directory: str = None, max_bytes: int = 2 * 1024 ** 3):
+        self.directory: str = os.path.join(get_cache_directory(), 'files') if directory is None else directory
+        self.max_bytes: int = max_bytes
+        # FileReaderがメモリマップで開いているエントリと，開いているFileReaderの数．evictで削除しない
+        self.pinned: dict = {}
+
+    def get_entry(self, filename: str) -> str:
+        key = hashlib.sha1(os.path.abspath(filename).encode()).hexdigest()
+        return os.path.join(self.directory, key)
+
+    def read_meta(self, filename: str):
+        # filenameの今の更新時刻・サイズで有効なエントリのメタデータ．なければNone
+        try:
+            with open(os.path.join(self.get_entry(filename), 'meta.json'), 'r') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        stat = os.stat(filename)
+        if meta['version'] != CACHE_VERSION or meta['mtime'] != stat.st_mtime_ns or meta['size'] != stat.st_size:
+            return None
+        return meta
+
+    def load(self, filename: str, mmap: list = ()):
+        # 有効なエントリがなければNoneを返す．mmapに含まれる配列はメモリマップ(読み取り専用)で開く
+        # 複数のプロセスで共有する(batch --workers)ので，読んでいる途中で他のプロセスに消された場合もNoneを返す
+        meta = self.read_meta(filename)
+        if meta is None:
+            return None
+        entry = self.get_entry(filename)
+        try:
+            arrays = {}
+            for name in meta['arrays']:
+                arrays[name] = np.load(os.path.join(entry, f'{name}.npy'), mmap_mode='r' if name in mmap else None)
+            os.utime(entry)  # 最後に使った時刻を削除の優先順位に使う
+        except (OSError, ValueError):
+            return None
+        return arrays, meta['header']
+
+    def get_entry_tmp(self, filename: str) -> str:
+        return f'{self.get_entry(filename)}.tmp{os.getpid()}'
+
+    def begin(self, filename: str) -> None:
+        # 書き込み途中のエントリを読まないよう，一時ディレクトリに書いてから置き換える
+        entry_tmp = self.get_entry_tmp(filename)
+        shutil.rmtree(entry_tmp, ignore_errors=True)
+        os.makedirs(entry_tmp)
+
+    def create_array(self, filename: str, name: str, shape: tuple, dtype=float) -> np.memmap:
+        # begin後，メモリに載らない配列を一時ディレクトリ上に直接作る．commitの前に参照を消すこと
+        return np.lib.format.open_memmap(
+            os.path.join(self.get_entry_tmp(filename), f'{name}.npy'), mode='w+', dtype=dtype, shape=shape)
+
+    def commit(self, filename: str, arrays: dict, header: dict) -> None:
+        entry = self.get_entry(filename)
+        entry_tmp = self.get_entry_tmp(filename)
+        for name, arr in arrays.items():
+            np.save(os.path.join(entry_tmp, f'{name}.npy'), arr)
+        stat = os.stat(filename)
+        meta = {
+            'version': CACHE_VERSION,
+            'filename': os.path.abspath(filename),
+            'mtime': stat.st_mtime_ns,
+            'size': stat.st_size,
+            'arrays': [name[:-4] for name in os.listdir(entry_tmp) if name.endswith('.npy')],
+            'header': header,
+        }
+        with open(os.path.join(entry_tmp, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        if self.read_meta(filename) is not None:
+            # 他のプロセスが同じファイルを先に保存した．読んでいる途中かもしれないので置き換えない
+            shutil.rmtree(entry_tmp, ignore_errors=True)
+            return
+        shutil.rmtree(entry, ignore_errors=True)
+        try:
+            os.rename(entry_tmp, entry)
+        except OSError:
+            # 古いエントリがメモリマップで開かれていて消せなかった場合は今回の保存をあきらめる
+            shutil.rmtree(entry_tmp, ignore_errors=True)
+            return
+
+        self.evict(keep=entry)
+
+    def save(self, filename: str, arrays: dict, header: dict) -> None:
+        self.begin(filename)
+        self.commit(filename, arrays, header)
+
+    def invalidate(self, filename: str) -> None:
+        shutil.rmtree(self.get_entry(filename), ignore_errors=True)
+
+    def clear(self) -> None:
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def get_size(self, entry: str) -> int:
+        return sum(e.stat().st_size for e in os.scandir(entry) if e.is_file())
+
+    def pin(self, filename: str) -> None:
+        entry = self.get_entry(filename)
+        self.pinned[entry] = self.pinned.get(entry, 0) + 1
+
+    def unpin(self, filename: str) -> None:
+        entry = self.get_entry(filename)
+        if self.pinned.get(entry, 0) <= 1:
+            self.pinned.pop(entry, None)
+        else:
+            self.pinned[entry] -= 1
+
+    def evict(self, keep: str = None) -> None:
+        # 合計サイズがmax_bytesを超えたら，使われていない順に削除
+        # 開いているエントリ(lazyで読み込んだマップなど)はmax_bytesを超えていても残す
+        # 他のプロセスが同時に消したエントリは数えない
+        mtimes = get_entry_mtimes(self.directory)
+        sizes = {}
+        for entry in mtimes:
+            try:
+                sizes[entry] = self.get_size(entry)
+            except FileNotFoundError:
+                continue
+        entries = sorted(sizes, key=mtimes.get)
+        total = sum(sizes.values())
+        for entry in entries:
+            if total <= self.max_bytes:
+                break
+            if entry == keep or entry in self.pinned:
+                continue
+            total -= sizes[entry]
+            shutil.rmtree(entry, ignore_errors=True)
+
+
+def get_file_hash(filename: str, block_bytes: int = 2 ** 20) -> str:
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_bytes), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class CalibrationCache:
+    # 参照ファイルの中身と校正の設定ごとに，校正後の波長軸とcalibration_infoを保存しておく
+    # 同じ参照ファイル・中心波長で多くのマップを校正する場合，ピーク探索とフィットを省ける
+    def __init__(self, directory: str = None, max_entries: int = 256):
+        self.directory: str = os.path.join(get_cache_directory(), 'calibrations') if directory is None else directory
+        self.max_entries: int = max_entries
+        # ファイルの中身のハッシュ．パス，更新時刻，サイズが同じなら計算し直さない
+        self.file_hashes: dict = {}
+
+    def get_reference_hash(self, filename: str) -> str:
+        stat = os.stat(filename)
+        key = (os.path.abspath(filename), stat.st_mtime_ns, stat.st_size)
+        if key not in self.file_hashes:
+            self.file_hashes[key] = get_file_hash(filename)
+        return self.file_hashes[key]
+
+    def get_key(self, filename_ref: str, center: float, material: str, dimension: int, function: str, easy: bool) -> str:
+        # ファイル名ではなく中身で区別するので，コピーや移動した参照ファイルでも使える
+        settings = [CALIBRATION_CACHE_VERSION, self.get_reference_hash(filename_ref), float(center), material, int(dimension), function, bool(easy)]
+        return hashlib.sha1(json.dumps(settings).encode()).hexdigest()
+
+    def load(self, key: str):
+        # (校正後の波長軸, calibration_info)を返す．なければNone
+        entry = os.path.join(self.directory, key)
+        try:
+            xdata = np.load(os.path.join(entry, 'xdata.npy'))
+            with open(os.path.join(entry, 'calibration_info.pkl'), 'rb') as f:
+                calibration_info = pickle.load(f)
+            os.utime(entry)  # 最後に使った時刻を削除の優先順位に使う
+        except (OSError, ValueError, EOFError, pickle.UnpicklingError):
+            # 他のプロセス(batch --workers)に消された場合も，なかったことにする
+            return None
+        return xdata, calibration_info
+
+    def save(self, key: str, xdata: np.ndarray, calibration_info) -> None:
+        # 一時ディレクトリに書いてから置き換える．同時に書き込まれた場合は先に書いた方を残す
+        entry = os.path.join(self.directory, key)
+        entry_tmp = f'{entry}.tmp{os.getpid()}'
+        shutil.rmtree(entry_tmp, ignore_errors=True)
+        os.makedirs(entry_tmp)
+        np.save(os.path.join(entry_tmp, 'xdata.npy'), xdata)
+        with open(os.path.join(entry_tmp, 'calibration_info.pkl'), 'wb') as f:
+            pickle.dump(calibration_info, f)
+        try:
+            os.rename(entry_tmp, entry)
+        except OSError:
+            shutil.rmtree(entry_tmp, ignore_errors=True)
+            return
+        self.evict()
+
+    def invalidate(self, key: str) -> None:
+        shutil.rmtree(os.path.join(self.directory, key), ignore_errors=True)
+
+    def clear(self) -> None:
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def evict(self) -> None:
+        # max_entriesを超えたら，使われていない順に削除
+        mtimes = get_entry_mtimes(self.directory)
+        entries = sorted(mtimes, key=mtimes.get)
+        for entry in entries[:max(0, len(entries) - self.max_entries)]:
+            shutil.rmtree(entry, ignore_errors=True)
@@ -0,0 +1 @@
+# テストからリポジトリ直下のモジュール(utils.pyなど)をimportできるよう，pytestにこのディレクトリをsys.pathへ加えさせる
@@ -9,9 +9,16 @@ import matplotlib.backend_bases
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
 from matplotlib.backend_bases import key_press_handler
 from RayleighCalibrator import RayleighCalibrator
+from cache import FileCache, CalibrationCache
+from worker import Worker
+from profiler import profiler, profile
+from peakfit import parameter_names
 
 
 class MainWindow(tk.Frame):
+    # ファイルの読み込みを行うWorkerのstage
+    load_stages = ['raw', 'bg', 'ref']
+
     def __init__(self, master: tk.Tk) -> None:
         super().__init__(master)
         self.master = master
@@ -23,14 +30,30 @@ class MainWindow(tk.Frame):
             self.height_master = 600
         self.master.geometry(f'{self.width_master}x{self.height_master}')
 
-        self.calibrator = RayleighCalibrator()
+        # 一度開いたファイルはバイナリでキャッシュし，次回から高速に開く．校正結果も参照ファイル・設定ごとに使い回す
+        self.calibrator = RayleighCalibrator(cache=FileCache(), calibration_cache=CalibrationCache())
 
         # スペクトルの線．Auto ScaleをOffにした際にスケールを保つため，スペクトルを更新する際は線のみ削除する
         self.line = []
+        # マップ上で表示中のスペクトルを示す線
+        self.horizontal_line_1 = None
+        self.horizontal_line_2 = None
+        # XY表示で，表示中のスペクトルの位置を示す印
+        self.marker = None
+        self.legend = None
+        # blit用に保存した，表示中のスペクトルの線とマップ上の線を除いた図の画像
+        self.background = None
+        self.capturing_background = False
 
         # フォルダ選択ダイアログを開く際のデフォルトディレクトリ
         self.folder = './'
 
+        # ファイルの読み込みや処理は別スレッドで行い，画面を固まらせない
+        self.worker = Worker(self.master)
+        # 別スレッドの処理中に無効にするウィジェットと，処理前の状態(処理中でなければNone)
+        self.controls: list = []
+        self.control_states: dict = None
+
         self.create_widgets()
 
     def create_widgets(self) -> None:
@@ -51,6 +74,7 @@ class MainWindow(tk.Frame):
         toolbar.grid(row=3, column=0)
         plt.subplots_adjust(left=0.05, right=0.99, bottom=0.05, top=0.99)
         fig.canvas.mpl_connect('button_press_event', self.on_click)
+        fig.canvas.mpl_connect('draw_event', self.on_draw)
         self.canvas.mpl_connect('key_press_event', self.key_pressed)
         self.canvas.mpl_connect('key_press_event', key_press_handler)
 
@@ -64,6 +88,28 @@ class MainWindow(tk.Frame):
         frame_selected.grid(row=1, column=1, columnspan=2)
         frame_download.grid(row=2, column=1)
         frame_plot.grid(row=2, column=2)
+        frame_status = tk.LabelFrame(self.master, text='Status')
+        frame_status.grid(row=3, column=1, columnspan=2)
+
+        # frame_status
+        # 別スレッドで実行中の処理の進捗と取り消しボタン
+        self.status = tk.StringVar(value='')
+        label_status = tk.Label(frame_status, textvariable=self.status, width=30)
+        self.progressbar = ttk.Progressbar(frame_status, length=150, maximum=1.0)
+        self.button_cancel = tk.Button(frame_status, text='CANCEL', command=self.cancel, state=tk.DISABLED)
+
+        # 読み込み・処理・描画にかかった時間の計測．Onの間だけ記録する
+        self.profiling = tk.BooleanVar(value=False)
+        checkbutton_profile = tk.Checkbutton(frame_status, text='Profile', variable=self.profiling, command=self.switch_profiling)
+        button_show_profile = tk.Button(frame_status, text='SHOW', command=self.show_profile)
+        button_dump_profile = tk.Button(frame_status, text='DUMP', command=self.dump_profile)
+
+        label_status.grid(row=0, column=0)
+        self.progressbar.grid(row=0, column=1)
+        self.button_cancel.grid(row=0, column=2)
+        checkbutton_profile.grid(row=0, column=3)
+        button_show_profile.grid(row=0, column=4)
+        button_dump_profile.grid(row=0, column=5)
 
         # frame_data
         # inputしたデータやキャリブレーションの設定，background correctionやcosmic ray removalの設定もできる
@@ -82,7 +128,7 @@ class MainWindow(tk.Frame):
         label_filename_ref.bind('<Button-1>', self.show_ref)
         label_center = tk.Label(frame_data, text='Center [nm]:')
         self.center = tk.DoubleVar(value=self.calibrator.center)
-        combobox_center = ttk.Combobox(frame_data, textvariable=self.center, values=[500, 630, 760], width=7, justify=tk.CENTER)
+        combobox_center = ttk.Combobox(frame_data, textvariable=self.center, values=self.calibrator.center_list, width=7, justify=tk.CENTER)
         self.material = tk.StringVar(value=self.calibrator.get_material_list()[0])
         optionmenu_material = tk.OptionMenu(frame_data, self.material, *self.calibrator.get_material_list())
         self.dimension = tk.StringVar(value=self.calibrator.get_dimension_list()[0])
@@ -99,6 +145,16 @@ class MainWindow(tk.Frame):
         self.smoothing = tk.BooleanVar(value=False)
         self.checkbutton_sm = tk.Checkbutton(frame_data, text='Smooth', variable=self.smoothing, command=self.reload, state=tk.DISABLED)
         self.button_calibrate = tk.Button(frame_data, text='CALIBRATE', command=self.calibrate, state=tk.DISABLED)
+        # RAMに載らない大きなマップ用．次にdropしたマップから有効
+        self.lazy = tk.BooleanVar(value=False)
+        self.checkbutton_lazy = tk.Checkbutton(frame_data, text='Lazy', variable=self.lazy, command=self.switch_lazy)
+        # マップをfloat32で保持してメモリを半分にする．次にdropしたマップから有効
+        self.float32 = tk.BooleanVar(value=False)
+        self.checkbutton_float32 = tk.Checkbutton(frame_data, text='float32', variable=self.float32, command=self.switch_float32)
+        # 積算したスペクトル(表示に使う)の処理の仕方．accumulatedが最も速いが，積算前のスペクトルは保存できなくなる
+        self.accumulated_mode = tk.StringVar(value=self.calibrator.accumulated_mode)
+        self.optionmenu_accumulated_mode = tk.OptionMenu(frame_data, self.accumulated_mode, *self.calibrator.accumulated_modes,
+                                                         command=self.switch_accumulated_mode)
 
         label_raw.grid(row=0, column=0)
         label_filename_raw.grid(row=0, column=1, columnspan=2)
@@ -108,6 +164,9 @@ class MainWindow(tk.Frame):
         label_filename_ref.grid(row=2, column=1, columnspan=2)
         label_center.grid(row=3, column=0)
         combobox_center.grid(row=3, column=1, columnspan=2)
+        self.checkbutton_lazy.grid(row=3, column=3)
+        self.checkbutton_float32.grid(row=2, column=3)
+        self.optionmenu_accumulated_mode.grid(row=1, column=3)
         optionmenu_material.grid(row=4, column=0)
         optionmenu_dimension.grid(row=4, column=1)
         self.optionmenu_function.grid(row=4, column=2)
@@ -189,6 +248,24 @@ class MainWindow(tk.Frame):
         self.autoscale = tk.BooleanVar(value=True)
         checkbox_autoscale = tk.Checkbutton(frame_plot, text='Auto Scale', variable=self.autoscale)
         self.button_apply = tk.Button(frame_plot, text='APPLY', command=self.imshow, width=7, state=tk.DISABLED)
+        # XYがOnの場合，マップを位置の座標どおりに並べ，波長帯[band_1, band_2]の積分強度を表示する
+        self.xy = tk.BooleanVar(value=False)
+        self.checkbox_xy = tk.Checkbutton(frame_plot, text='XY', variable=self.xy, command=self.switch_xy, state=tk.DISABLED)
+        self.band_1 = tk.DoubleVar(value=0)
+        self.band_2 = tk.DoubleVar(value=0)
+        entry_band_1 = tk.Entry(frame_plot, textvariable=self.band_1, width=7, justify=tk.CENTER)
+        entry_band_2 = tk.Entry(frame_plot, textvariable=self.band_2, width=7, justify=tk.CENTER)
+        # XY表示する値．intensity以外は，波長帯のピークを全位置でフィットした(FIT)パラメータ
+        self.xy_value = tk.StringVar(value='intensity')
+        self.optionmenu_xy_value = tk.OptionMenu(frame_plot, self.xy_value, *(['intensity'] + parameter_names + ['rms']), command=self.switch_xy)
+        self.optionmenu_xy_value.config(state=tk.DISABLED)
+        self.button_fit = tk.Button(frame_plot, text='FIT', command=self.fit_peaks, width=7, state=tk.DISABLED)
+        # FITとCRR・Smoothを並列に処理するプロセスの数．1なら並列にしない
+        label_workers = tk.Label(frame_plot, text='Workers:')
+        self.workers = tk.IntVar(value=1)
+        self.spinbox_workers = tk.Spinbox(frame_plot, textvariable=self.workers, from_=1, to=os.cpu_count() or 1, width=5,
+                                          justify=tk.CENTER, command=self.switch_workers)
+        self.spinbox_workers.bind('<Return>', self.switch_workers)
 
         entry_color_range_1.grid(row=0, column=0)
         entry_color_range_2.grid(row=0, column=1)
@@ -196,6 +273,19 @@ class MainWindow(tk.Frame):
         self.optionmenu_map_color.grid(row=2, column=0, columnspan=2)
         self.checkbox_ev.grid(row=3, column=0)
         checkbox_autoscale.grid(row=3, column=1)
+        self.checkbox_xy.grid(row=4, column=0, columnspan=2)
+        entry_band_1.grid(row=5, column=0)
+        entry_band_2.grid(row=5, column=1)
+        self.optionmenu_xy_value.grid(row=6, column=0)
+        self.button_fit.grid(row=6, column=1)
+        label_workers.grid(row=7, column=0)
+        self.spinbox_workers.grid(row=7, column=1)
+
+        # 処理中にcalibratorのデータや設定を読み書きするウィジェット．処理が終わるまで無効にする
+        self.controls = [self.checkbutton_lazy, self.checkbutton_float32, self.optionmenu_accumulated_mode,
+                         self.button_calibrate, self.button_save_each, self.button_save_map, self.button_apply,
+                         self.optionmenu_map_color, self.checkbox_xy, self.optionmenu_xy_value, self.button_fit,
+                         self.spinbox_workers]
 
         # canvas_drop
         # ファイルをドラッグ&ドロップする際のガイド用のウィジェット．基本は非表示．
@@ -218,6 +308,96 @@ class MainWindow(tk.Frame):
         else:
             self.optionmenu_function.config(state=tk.ACTIVE)
 
+    def switch_lazy(self):
+        # マップをメモリマップのまま扱うかどうか
+        self.calibrator.set_lazy(self.lazy.get())
+
+    def switch_profiling(self):
+        if self.profiling.get():
+            profiler.enable()
+        else:
+            profiler.disable()
+
+    def show_profile(self):
+        # 区間ごとの集計を別ウィンドウに表示
+        window = tk.Toplevel(self.master)
+        window.title('Profile')
+        text = tk.Text(window, width=101, height=20, font=('Courier', 10))
+        text.insert(tk.END, profiler.format())
+        text.config(state=tk.DISABLED)
+        text.pack(fill=tk.BOTH, expand=True)
+        button_clear = tk.Button(window, text='CLEAR', command=lambda: (profiler.clear(), window.destroy()))
+        button_clear.pack()
+
+    def dump_profile(self):
+        # 区間ごとの集計と，すべての記録をJSONで保存
+        filename = filedialog.asksaveasfilename(initialdir=self.folder, initialfile='profile.json')
+        if not filename:
+            return
+        profiler.dump(filename)
+
+    def switch_xy(self, event=None):
+        # 行ごとの表示と位置の座標どおりの表示を切り替える．色の範囲は表示するものに合わせて設定し直す
+        self.set_color_range()
+        self.imshow()
+        self.update_plot()
+
+    def set_color_range(self) -> None:
+        if self.xy.get():
+            try:
+                values = self.calibrator.get_map_values([self.band_1.get(), self.band_2.get()], self.xy_value.get())
+            except ValueError as e:
+                messagebox.showerror('Error', str(e))
+                return
+            color_range = [np.nanmin(values), np.nanmax(values)]
+        else:
+            color_range = self.calibrator.get_color_range()
+        if self.xy.get() and self.xy_value.get() != 'intensity':
+            # フィットのパラメータ(中心波長など)は範囲が狭いので整数に丸めない
+            self.color_range_1.set(float(f'{color_range[0]:.6g}'))
+            self.color_range_2.set(float(f'{color_range[1]:.6g}'))
+            return
+        self.color_range_1.set(round(color_range[0]))
+        self.color_range_2.set(round(color_range[1]))
+
+    def fit_peaks(self):
+        # 波長帯[band_1, band_2]のピークを全位置でフィットし，結果(中心波長)をXY表示する
+        band = [self.band_1.get(), self.band_2.get()]
+        function = self.function.get()
+        self.run_in_background(
+            'fit', 'Fitting',
+            lambda task: self.calibrator.fit_peaks(
+                band, function, callback=lambda i, n: task.progress(i / n, f'Fitting {i}/{n}')),
+            lambda result: self.after_fit_peaks())
+
+    def after_fit_peaks(self):
+        self.xy.set(True)
+        self.xy_value.set('center')
+        self.switch_xy()
+
+    def check_xy_value(self):
+        # 処理や校正を変えて，今のデータでフィットした結果がなくなった場合は積分強度の表示に戻す
+        if self.xy.get() and self.xy_value.get() != 'intensity' and self.calibrator.peak_parameters is None:
+            self.xy_value.set('intensity')
+            self.set_color_range()
+
+    def switch_workers(self, event=None):
+        try:
+            workers = self.workers.get()
+        except tk.TclError:
+            workers = 1
+        workers = max(1, workers)
+        self.workers.set(workers)
+        self.calibrator.set_executor(workers if workers > 1 else 0)
+
+    def switch_float32(self):
+        self.calibrator.set_dtype('float32' if self.float32.get() else 'float64')
+
+    def switch_accumulated_mode(self, event=None):
+        self.calibrator.set_accumulated_mode(self.accumulated_mode.get())
+        if self.calibrator.map_data is not None:
+            self.reload()
+
     def switch_ev(self):
         # X軸を波長にするかエネルギーにするか
         if self.ev.get():
@@ -227,49 +407,141 @@ class MainWindow(tk.Frame):
         self.reload()
 
     def calibrate(self) -> None:
-        self.calibrator.reset_ref_data()
-        self.calibrator.set_initial_xdata(self.center.get())
-        self.calibrator.set_dimension(int(self.dimension.get()[0]))
-        self.calibrator.set_material(self.material.get())
-        self.calibrator.set_function(self.function.get())
-        self.calibrator.set_search_width(5)
-        ok = self.calibrator.calibrate(easy=self.easy.get())
+        ok = self.calibrator.calibrate_reference(
+            center=self.center.get(),
+            dimension=int(self.dimension.get()[0]),
+            material=self.material.get(),
+            function=self.function.get(),
+            easy=self.easy.get())
         if not ok:
             messagebox.showerror('Error', 'Peaks not found.')
             return
         self.ax[1].cla()
-        self.calibrator.show_fit_result(self.ax[1])
+        if self.calibrator.calibration_reused:
+            # キャッシュから読み込んだ場合はフィットの結果がないので，校正後の軸で参照スペクトルを表示
+            self.ax[1].plot(self.calibrator.xdata, self.calibrator.ydata, color='k', label='reference (cached calibration)')
+            self.ax[1].legend()
+        else:
+            self.calibrator.show_fit_result(self.ax[1])
         self.canvas.draw()
 
         self.line = []
+        self.check_xy_value()
         self.imshow()  # to update the xticklabels
 
     def reload(self):
         # background correctionやcosmic ray removalの設定，ファイルの読み込み時にグラフを更新するための関数
-        # 二重にbackground correctionやcosmic ray removalをかけないよう，まず生データをセットする
-        self.calibrator.reset_map_data()
-        if self.do_background_correction.get():
-            if self.calibrator.reader_bg.filename == '':
-                messagebox.showerror(title='Error', message='No background data.')
-                return
-            self.calibrator.correct_background()
-        if self.cosmic_ray_removal.get():
-            self.calibrator.remove_cosmic_ray()
-        if self.smoothing.get():
-            self.calibrator.smooth()
+        # 生データから処理するが，設定の変わっていない段階の結果はcalibratorが使い回す
+        if self.do_background_correction.get() and self.calibrator.reader_bg.filename == '':
+            messagebox.showerror(title='Error', message='No background data.')
+            return
+        background = self.do_background_correction.get()
+        cosmic_ray = self.cosmic_ray_removal.get()
+        smoothing = self.smoothing.get()
+        self.run_in_background(
+            'process', 'Processing',
+            lambda task: self.calibrator.process(
+                background=background, cosmic_ray=cosmic_ray, smoothing=smoothing,
+                callback=lambda i, n, name: task.progress(i / n, name)),
+            lambda result: self.after_reload())
+
+    def after_reload(self):
+        self.check_xy_value()
         self.imshow()
         self.update_plot()
 
+    def run_in_background(self, stage: str, message: str, func, on_done) -> None:
+        # funcを別スレッドで実行し，終わったらメインスレッドでon_done(結果)を呼ぶ
+        # 同じstageの処理が実行中の場合，古い方は取り消され結果も使われない
+        self.status.set(message)
+        self.progressbar['value'] = 0
+        self.worker.submit(
+            stage, func,
+            on_done=lambda result: self.finish_background(on_done, result),
+            on_error=self.show_background_error,
+            on_progress=self.show_progress)
+        self.set_controls_enabled(False)
+        self.update_cancel_button()
+
+    def finish_background(self, on_done, result) -> None:
+        self.update_status()
+        on_done(result)
+
+    def show_background_error(self, error: Exception) -> None:
+        self.update_status()
+        messagebox.showerror('Error', str(error))
+
+    def show_progress(self, fraction: float, message: str) -> None:
+        self.progressbar['value'] = fraction
+        self.status.set(message)
+
+    def update_status(self) -> None:
+        self.update_cancel_button()
+        if self.worker.is_busy():
+            return
+        self.status.set('')
+        self.progressbar['value'] = 0
+        self.set_controls_enabled(True)
+
+    def set_controls_enabled(self, enabled: bool) -> None:
+        # 無効にする際は元の状態を覚えておき，有効にする際はその状態に戻す
+        if not enabled:
+            if self.control_states is None:
+                self.control_states = {widget: widget.cget('state') for widget in self.controls}
+            for widget in self.controls:
+                widget.config(state=tk.DISABLED)
+        elif self.control_states is not None:
+            for widget, state in self.control_states.items():
+                widget.config(state=state)
+            self.control_states = None
+
+    def activate(self, widget) -> None:
+        # 処理中なら，処理が終わってから有効にする
+        if self.control_states is not None and widget in self.control_states:
+            self.control_states[widget] = tk.ACTIVE
+        else:
+            widget.config(state=tk.ACTIVE)
+
+    def update_cancel_button(self) -> None:
+        # 読み込みは途中で止められず，取り消しても読み込んだデータがcalibratorに残ってしまうので，読み込み中は取り消せない
+        loading = any(stage in self.worker.tasks for stage in self.load_stages)
+        if self.worker.is_busy() and not loading:
+            self.button_cancel.config(state=tk.ACTIVE)
+        else:
+            self.button_cancel.config(state=tk.DISABLED)
+
+    def cancel(self) -> None:
+        # 処理やフィットの区切りで止まる
+        self.worker.cancel()
+        self.status.set('Cancelling...')
+        self.master.after(self.worker.interval, self.wait_cancel)
+
+    def wait_cancel(self) -> None:
+        if self.worker.is_busy():
+            self.master.after(self.worker.interval, self.wait_cancel)
+            return
+        self.update_status()
+
     def on_click(self, event: matplotlib.backend_bases.MouseEvent) -> None:
         # マップをクリックして表示するスペクトルを選択
-        if event.ydata is None:
+        if event.ydata is None or self.worker.is_busy():
             return
         # 右側のプロットには反応させない
         if os.name == 'nt' and event.x > self.width_canvas / 2:
             return
         if os.name == 'posix' and event.x > self.width_canvas:
             return
-        self.index_to_show.set(int(np.floor(event.ydata)))
+        if self.xy.get():
+            try:
+                index = self.calibrator.get_index_at(event.xdata, event.ydata)
+            except ValueError as e:
+                messagebox.showerror('Error', str(e))
+                return
+            if index < 0:
+                return
+            self.index_to_show.set(index)
+        else:
+            self.index_to_show.set(int(np.floor(event.ydata)))
         self.update_position_info()
         self.update_plot()
 
@@ -278,7 +550,9 @@ class MainWindow(tk.Frame):
         if event.key == 'enter':
             self.reload()
             return
-        # 上下ボタンを押したら表示するスペクトルを変更
+        # 上下ボタンを押したら表示するスペクトルを変更．読み込み・処理中は何もしない
+        if self.worker.is_busy():
+            return
         index_selected = self.index_to_show.get()
         if event.key == 'up' and index_selected < self.calibrator.data_length - 1:
             self.index_to_show.set(index_selected + 1)
@@ -298,26 +572,58 @@ class MainWindow(tk.Frame):
         self.pos_y.set(y)
         self.pos_z.set(z)
 
+    @profile()
     def imshow(self, event=None) -> None:
         # マップを表示
         if self.calibrator.map_data is None:
             return
-        self.ax[0].cla()
-        # 表示中のスペクトルを点線で挟んで示してあげる
-        self.horizontal_line_1 = self.ax[0].axhline(color='w', lw=1.5, ls='--')
-        self.horizontal_line_1.set_visible(True)
-        self.horizontal_line_2 = self.ax[0].axhline(color='w', lw=1.5, ls='--')
-        self.horizontal_line_2.set_visible(True)
-        self.calibrator.imshow(self.ax[0], [self.color_range_1.get(), self.color_range_2.get()], self.map_color.get(), ev=self.ev.get())
+        # 画像や線は作り直さず，calibratorが既存の画像のデータや色を更新する
+        color_range = [self.color_range_1.get(), self.color_range_2.get()]
+        if self.xy.get():
+            try:
+                values = self.calibrator.get_map_values([self.band_1.get(), self.band_2.get()], self.xy_value.get())
+                self.calibrator.imshow_xy(self.ax[0], values, color_range, self.map_color.get())
+            except ValueError as e:
+                messagebox.showerror('Error', str(e))
+                return
+        else:
+            self.calibrator.imshow(self.ax[0], color_range, self.map_color.get(), ev=self.ev.get())
+        if self.horizontal_line_1 is None:
+            # 表示中のスペクトルを点線で挟んで示してあげる
+            self.horizontal_line_1 = self.ax[0].axhline(color='w', lw=1.5, ls='--')
+            self.horizontal_line_2 = self.ax[0].axhline(color='w', lw=1.5, ls='--')
+            # XY表示では位置を四角で囲んで示す
+            self.marker, = self.ax[0].plot([], [], ls='none', marker='s', ms=10, mfc='none', mec='w', mew=1.5)
+        self.horizontal_line_1.set_visible(not self.xy.get())
+        self.horizontal_line_2.set_visible(not self.xy.get())
+        self.marker.set_visible(self.xy.get())
         self.canvas.draw()
 
+    @profile()
     def update_plot(self) -> None:
         index_to_show = self.index_to_show.get()
         # 範囲外のインデックスの場合は表示を更新しない
         if not (0 <= index_to_show < self.calibrator.data_length):
             return
-        self.horizontal_line_1.set_ydata(index_to_show)
-        self.horizontal_line_2.set_ydata(index_to_show + 1)
+        self.horizontal_line_1.set_ydata([index_to_show, index_to_show])
+        self.horizontal_line_2.set_ydata([index_to_show + 1, index_to_show + 1])
+        self.marker.set_data(*self.calibrator.reader_raw.pos_arr_absolute_accumulated[index_to_show, :2, np.newaxis])
+
+        x = self.calibrator.xdata.copy()
+        if self.ev.get():
+            x = 1240 / x
+        y = self.calibrator.map_data_accumulated[index_to_show]
+        label = f'{index_to_show} ({self.pos_x.get()}, {self.pos_y.get()}, {self.pos_z.get()})'
+        if self.calibrator.peak_parameters is not None:
+            label += f' center: {self.calibrator.peak_parameters["center"][index_to_show]:.2f}'
+
+        # Auto ScaleがOffで表示中のスペクトルの線がある場合は，線のデータだけ差し替えてblitで描き直す
+        if not self.autoscale.get() and self.is_browsing():
+            self.line[0].set_data(x, y)
+            self.line[0].set_label(label)
+            self.legend.get_texts()[0].set_text(label)
+            self.blit()
+            return
 
         # AutoScale関係の設定
         if self.autoscale.get():
@@ -330,16 +636,48 @@ class MainWindow(tk.Frame):
             else:  # for after calibration
                 self.ax[1].cla()
 
-        x = self.calibrator.xdata.copy()
-        if self.ev.get():
-            x = 1240 / x
-        self.line = self.ax[1].plot(
-            x,
-            self.calibrator.map_data_accumulated[index_to_show],
-            label=f'{index_to_show} ({self.pos_x.get()}, {self.pos_y.get()}, {self.pos_z.get()})', color='r', linewidth=0.8)
-        self.ax[1].legend()
+        self.line = self.ax[1].plot(x, y, label=label, color='r', linewidth=0.8, gid='spectrum')
+        self.legend = self.ax[1].legend()
         self.canvas.draw()
 
+    def is_browsing(self) -> bool:
+        # update_plotで作ったスペクトルの線が表示中かどうか
+        return bool(self.line) and self.line[0].get_gid() == 'spectrum' and self.line[0].axes is not None
+
+    def get_blit_artists(self) -> list:
+        if self.xy.get():
+            artists = [self.marker]
+        else:
+            artists = [self.horizontal_line_1, self.horizontal_line_2]
+        if self.is_browsing():
+            artists += [self.line[0], self.legend]
+        return [artist for artist in artists if artist is not None and artist.axes is not None]
+
+    def on_draw(self, event) -> None:
+        # 図全体が描き直されたら，保存した画像は使えない
+        if not self.capturing_background:
+            self.background = None
+
+    @profile()
+    def blit(self) -> None:
+        # 保存した画像に線だけを描き足して表示する．図全体は描き直さない
+        artists = self.get_blit_artists()
+        if self.background is None:
+            # 線を隠して一度だけ図全体を描き，その画像を保存する
+            for artist in artists:
+                artist.set_visible(False)
+            self.capturing_background = True
+            self.canvas.draw()
+            self.capturing_background = False
+            self.background = self.canvas.copy_from_bbox(self.canvas.figure.bbox)
+            for artist in artists:
+                artist.set_visible(True)
+        self.canvas.restore_region(self.background)
+        for artist in artists:
+            self.canvas.figure.draw_artist(artist)
+        self.canvas.blit(self.canvas.figure.bbox)
+        self.canvas.flush_events()
+
     def show_bg(self, event=None):
         if self.calibrator.reader_bg.filename == '':
             return
@@ -397,48 +735,67 @@ class MainWindow(tk.Frame):
         if os.name == 'posix':
             threshold *= 2
 
+        # 読み込みは別スレッドで行い，終わってから画面を更新する
         if dropped_place < threshold:  # raw data
-            self.calibrator.load_raw(filename)
-            self.filename_raw.set(os.path.basename(filename))
-            self.folder = os.path.dirname(filename)
-            self.checkbutton_crr.config(state=tk.ACTIVE)
-            self.checkbutton_sm.config(state=tk.ACTIVE)
-
-            self.optionmenu_map_color.config(state=tk.ACTIVE)
-            self.button_apply.config(state=tk.ACTIVE)
-            self.checkbox_ev.config(state=tk.ACTIVE)
-            self.color_range_1.set(round(self.calibrator.map_data_accumulated.min()))
-            self.color_range_2.set(round(self.calibrator.map_data_accumulated.max()))
-
-            self.reset_when_drop_raw()
-            self.reload()
-            self.imshow()
-            self.update_plot()
+            self.run_in_background(
+                'raw', f'Loading {os.path.basename(filename)}',
+                lambda task: self.calibrator.load_raw(filename),
+                lambda result: self.after_drop_raw(filename))
         elif dropped_place < threshold * 2:  # background data
-            self.calibrator.load_bg(filename)
-            self.filename_bg.set(os.path.basename(filename))
-            self.checkbutton_bg.config(state=tk.ACTIVE)
+            self.run_in_background(
+                'bg', f'Loading {os.path.basename(filename)}',
+                lambda task: self.calibrator.load_bg(filename),
+                lambda result: self.after_drop_bg(filename))
+        else:  # reference data
+            self.run_in_background(
+                'ref', f'Loading {os.path.basename(filename)}',
+                lambda task: self.calibrator.load_ref(filename),
+                lambda result: self.after_drop_ref(filename))
+
+    def after_drop_raw(self, filename: str) -> None:
+        self.filename_raw.set(os.path.basename(filename))
+        self.folder = os.path.dirname(filename)
+        self.checkbutton_crr.config(state=tk.ACTIVE)
+        self.checkbutton_sm.config(state=tk.ACTIVE)
+
+        self.activate(self.optionmenu_map_color)
+        self.activate(self.button_apply)
+        self.checkbox_ev.config(state=tk.ACTIVE)
+        self.activate(self.checkbox_xy)
+        self.activate(self.optionmenu_xy_value)
+        self.activate(self.button_fit)
+        self.xy_value.set('intensity')
+        self.band_1.set(round(self.calibrator.xdata.min(), 1))
+        self.band_2.set(round(self.calibrator.xdata.max(), 1))
+        self.set_color_range()
+
+        self.reset_when_drop_raw()
+        self.reload()
 
-            self.ax[1].cla()
-            self.ax[1].plot(self.calibrator.xdata, self.calibrator.bg_data_accumulated_smoothed, color='k', label='background')
-            self.canvas.draw()
+    def after_drop_bg(self, filename: str) -> None:
+        self.filename_bg.set(os.path.basename(filename))
+        self.checkbutton_bg.config(state=tk.ACTIVE)
 
-            if self.calibrator.reader_raw.filename != '':
-                self.imshow()
-        else:  # reference data
-            self.calibrator.load_ref(filename)
-            self.filename_ref.set(os.path.split(filename)[-1])
-            for material in self.calibrator.get_material_list():
-                if material in filename:
-                    self.material.set(material)
-            for center in ['500', '630', '760']:
-                if center in filename:
-                    self.center.set(float(center))
-            self.button_calibrate.config(state=tk.ACTIVE)
+        self.ax[1].cla()
+        self.ax[1].plot(self.calibrator.xdata, self.calibrator.bg_data_accumulated_smoothed, color='k', label='background')
+        self.canvas.draw()
 
-            self.ax[1].cla()
-            self.ax[1].plot(self.calibrator.xdata, self.calibrator.ydata, color='k', label='reference')
-            self.canvas.draw()
+        # 処理中の場合は，処理が終わってから表示し直される
+        if self.calibrator.reader_raw.filename != '' and not self.worker.is_busy():
+            self.imshow()
+
+    def after_drop_ref(self, filename: str) -> None:
+        self.filename_ref.set(os.path.split(filename)[-1])
+        material, center = self.calibrator.guess_reference_settings(filename)
+        if material is not None:
+            self.material.set(material)
+        if center is not None:
+            self.center.set(center)
+        self.activate(self.button_calibrate)
+
+        self.ax[1].cla()
+        self.ax[1].plot(self.calibrator.xdata, self.calibrator.ydata, color='k', label='reference')
+        self.canvas.draw()
 
     def drop_enter(self, event: TkinterDnD.DnDEvent) -> None:
         # ドラッグしてウィンドウに入ってきた時，ガイド用のウィジェットを表示する
@@ -487,70 +844,45 @@ class MainWindow(tk.Frame):
         for _ in range(len(self.file_to_download.get())):
             self.listbox.delete(0)
 
-    def write_header(self, f):
-        # スペクトルのデータを書き出す際，ファイルの最初のほうにメタデータを追加
-        abs_path_raw = self.calibrator.reader_raw.filename
-        abs_path_bg = self.calibrator.reader_bg.filename if self.do_background_correction.get() else ''
-        abs_path_ref = self.calibrator.reader_ref.filename
-        f.write(f'# abs_path_raw: {abs_path_raw}\n')
-        f.write(f'# abs_path_bg: {abs_path_bg}\n')
-        f.write(f'# abs_path_ref: {abs_path_ref}\n')
-        f.write(f'# calibration: {self.calibrator.calibration_info}\n')
-        f.write(f'# time: {self.calibrator.reader_raw.time}\n')
-        f.write(f'# integration: {self.calibrator.reader_raw.integration}\n')
-        f.write(f'# accumulation: {self.calibrator.reader_raw.accumulation}\n')
-        f.write(f'# interval: {self.calibrator.reader_raw.interval}\n')
-        f.write(f'# num_pos: {self.calibrator.reader_raw.num_pos}\n')
-
     def save_each(self) -> None:
         # インデックスごとに保存する
         if not self.file_to_download.get():
             messagebox.showinfo('Info', 'No file selected.')
             return
 
+        try:
+            self.calibrator.check_map_data()
+        except ValueError as e:
+            messagebox.showerror('Error', str(e))
+            return
+
         folder_to_save = filedialog.askdirectory(initialdir=self.folder)
         if not folder_to_save:
             return
 
         for index in self.file_to_download.get():
-            i1 = index * self.calibrator.reader_raw.accumulation
-            i2 = (index + 1) * self.calibrator.reader_raw.accumulation
-            map_data = np.vstack([self.calibrator.xdata, self.calibrator.map_data[i1:i2]]).T.astype(str)
-            pos_data = np.vstack([np.array(['pos_x', 'pos_y', 'pos_z']), self.calibrator.reader_raw.pos_arr[i1:i2]]).T.astype(str)
-
-            data = np.vstack([pos_data, map_data])
-
-            filename = os.path.join(folder_to_save, f'{index}.txt')
-            with open(filename, 'w') as f:
-                self.write_header(f)
-                for d in data:
-                    f.write(','.join(d) + '\n')
+            self.calibrator.save(os.path.join(folder_to_save, f'{index}.txt'), index)
 
     def save_map(self) -> None:
         if self.calibrator.reader_raw.filename == '':
             messagebox.showinfo('Info', 'No file.')
             return
+        try:
+            self.calibrator.check_map_data()
+        except ValueError as e:
+            messagebox.showerror('Error', str(e))
+            return
 
-        # マップデータとして保存
+        # マップデータとして保存．拡張子を.npzにするとバイナリで保存
         filename = filedialog.asksaveasfilename(initialdir=self.folder)
         if not filename:
             return
 
-        pos_data = self.calibrator.reader_raw.pos_arr
-        pos_data = np.vstack([np.array(['pos_x', 'pos_y', 'pos_z']), pos_data]).T.astype(str)
-
-        xdata = np.array(self.calibrator.xdata)
-        map_data = self.calibrator.map_data
-        map_data = np.vstack([xdata, map_data]).T.astype(str)
-
-        data = np.vstack([pos_data, map_data])
-
-        with open(filename, 'w') as f:
-            self.write_header(f)
-            for d in data:
-                f.write(','.join(d) + '\n')
+        self.calibrator.save(filename)
 
     def quit(self) -> None:
+        self.worker.shutdown()
+        self.calibrator.set_executor(0)
         self.master.quit()
         self.master.destroy()
 
@@ -0,0 +1,77 @@
+import os
+import numpy as np
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+
+
+def process_chunk(name: str, shape: tuple, dtype: str, start: int, stop: int, func, kwargs: dict) -> None:
+    # 共有メモリ上の配列のstart行目からstop行目までをfuncで処理し，同じ場所に書き戻す
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        data = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        data[start:stop] = func(data[start:stop], **kwargs)
+        del data
+    finally:
+        shm.close()
+
+
+def process_chunk_result(name: str, shape: tuple, dtype: str, start: int, stop: int, func, kwargs: dict):
+    # 共有メモリ上の配列のstart行目からstop行目までをfuncで処理し，結果を返す
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        data = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        result = func(data[start:stop], **kwargs)
+        del data
+    finally:
+        shm.close()
+    return result
+
+
+class RowExecutor:
+    # 行ごとに独立な処理(CRR, Smooth)を，行のまとまりに分けてプロセスプールで並列に処理する
+    # 配列は共有メモリを介して受け渡すので，配列全体をpickleすることはない
+    def __init__(self, workers: int = None, chunk_size: int = 256):
+        self.workers: int = os.cpu_count() if workers is None else workers
+        self.chunk_size: int = chunk_size
+        self.executor: ProcessPoolExecutor = None
+
+    def map_rows(self, func, data: np.ndarray, out: np.ndarray = None, **kwargs) -> np.ndarray:
+        # funcはプロセス間で受け渡すため，モジュールの最上位で定義された関数であること
+        # funcは受け取った行と同じ形の配列を返し，結果は共有メモリ上で元の行に書き戻される
+        # outを指定すると結果を新しい配列ではなくそこへ書き込む(data自身でもよい)
+        return self.run(process_chunk, func, data, kwargs, write_back=True, out=out)
+
+    def map_chunks(self, func, data: np.ndarray, **kwargs) -> np.ndarray:
+        # map_rowsと同じく行のまとまりごとに処理するが，funcの結果(行数は同じで列数は任意)を返してもらい縦につなげる
+        # 結果が入力より十分小さい場合(フィットのパラメータなど)に使う
+        return self.run(process_chunk_result, func, data, kwargs, write_back=False)
+
+    def run(self, process, func, data: np.ndarray, kwargs: dict, write_back: bool, out: np.ndarray = None) -> np.ndarray:
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        shm = shared_memory.SharedMemory(create=True, size=max(data.nbytes, 1))
+        try:
+            shared = np.ndarray(data.shape, dtype=data.dtype, buffer=shm.buf)
+            shared[:] = data
+            futures = [
+                self.executor.submit(process, shm.name, data.shape, data.dtype.str,
+                                     start, min(start + self.chunk_size, data.shape[0]), func, kwargs)
+                for start in range(0, data.shape[0], self.chunk_size)]
+            results = [future.result() for future in futures]
+            if write_back and out is not None:
+                out[...] = shared
+                result = out
+            elif write_back:
+                result = shared.copy()
+            else:
+                result = np.concatenate(results) if results else func(data[:0], **kwargs)
+            del shared
+        finally:
+            shm.close()
+            shm.unlink()
+        return result
+
+    def shutdown(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
@@ -0,0 +1,51 @@
+import numpy as np
+from scipy.optimize import curve_fit
+
+
+# パラメータの順番．widthは半値全幅
+parameter_names = ['center', 'width', 'amplitude', 'offset']
+
+
+def lorentzian(x, center, width, amplitude, offset):
+    return amplitude * (width / 2) ** 2 / ((x - center) ** 2 + (width / 2) ** 2) + offset
+
+
+def gaussian(x, center, width, amplitude, offset):
+    return amplitude * np.exp(-4 * np.log(2) * (x - center) ** 2 / width ** 2) + offset
+
+
+functions = {'Lorentzian': lorentzian, 'Gaussian': gaussian}
+
+
+def guess_parameters(x: np.ndarray, spectra: np.ndarray) -> np.ndarray:
+    # 全スペクトルの初期値を一括で求める．中心は最大値の位置，幅は半分の高さを超える点の数から
+    offset = spectra.min(axis=1)
+    peak = spectra.argmax(axis=1)
+    amplitude = spectra[np.arange(spectra.shape[0]), peak] - offset
+    above_half = spectra - offset[:, np.newaxis] > amplitude[:, np.newaxis] / 2
+    step = np.abs(np.median(np.diff(x))) if x.shape[0] > 1 else 1.0
+    width = np.maximum(above_half.sum(axis=1), 1) * step
+    return np.stack([x[peak], width, amplitude, offset], axis=1)
+
+
+def fit_peaks(spectra: np.ndarray, x: np.ndarray, function: str = 'Lorentzian', maxfev: int = 2000) -> np.ndarray:
+    # 各スペクトルにピーク1つ + 一定のベースラインをフィットする
+    # (スペクトル数, 5)の配列を返す．列はparameter_namesの順と残差の二乗平均平方根．失敗した場合はNaN
+    if function not in functions:
+        raise ValueError(f'Unknown function: {function}')
+    func = functions[function]
+    spectra = np.asarray(spectra, dtype=float)
+    result = np.full([spectra.shape[0], len(parameter_names) + 1], np.nan)
+    if spectra.shape[0] == 0 or x.shape[0] < len(parameter_names):
+        return result
+    lower = [x.min(), 0, -np.inf, -np.inf]
+    upper = [x.max(), np.ptp(x) * 2, np.inf, np.inf]
+    for i, (spectrum, p0) in enumerate(zip(spectra, guess_parameters(x, spectra))):
+        p0[1] = min(max(p0[1], upper[1] * 1e-6), upper[1])
+        try:
+            popt, _ = curve_fit(func, x, spectrum, p0=p0, bounds=(lower, upper), maxfev=maxfev)
+        except (RuntimeError, ValueError):
+            continue
+        result[i, :len(parameter_names)] = popt
+        result[i, -1] = np.sqrt(np.mean((func(x, *popt) - spectrum) ** 2))
+    return result
@@ -0,0 +1,161 @@
+import json
+import time
+import threading
+import functools
+import tracemalloc
+from contextlib import nullcontext
+
+
+class Section:
+    # ひとつの計測区間．with文で使う
+    def __init__(self, profiler, name: str, size=None):
+        self.profiler = profiler
+        self.name: str = name
+        self.size = size  # 処理したデータの大きさ[byte]．区間の終わりに呼ぶ関数でもよい
+        self.start: float = 0
+        self.memory_start: int = 0
+        self.memory_peak: int = 0
+        self.trace_memory: bool = False
+
+    def __enter__(self):
+        self.trace_memory = tracemalloc.is_tracing()
+        if self.trace_memory:
+            # tracemallocのピークはひとつしかないので，入れ子の外側の区間にはここまでのピークを渡してからリセットする
+            current, peak = tracemalloc.get_traced_memory()
+            for section in self.profiler.get_stack():
+                section.memory_peak = max(section.memory_peak, peak)
+            tracemalloc.reset_peak()
+            self.memory_start = self.memory_peak = current
+        self.profiler.get_stack().append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        stack = self.profiler.get_stack()
+        stack.remove(self)
+        allocated = retained = None
+        if self.trace_memory and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            self.memory_peak = max(self.memory_peak, peak)
+            for section in stack:
+                section.memory_peak = max(section.memory_peak, self.memory_peak)
+            allocated = self.memory_peak - self.memory_start
+            retained = current - self.memory_start
+        # 例外で抜けた場合，大きさは測れないことがある(保存に失敗したファイルなど)．元の例外を隠さないよう呼ばない
+        if callable(self.size):
+            size = None if exc[0] is not None else self.size()
+        else:
+            size = self.size
+        self.profiler.record(self.name, seconds, size, allocated, retained)
+        return False
+
+
+class Profiler:
+    # 読み込み・処理・描画などの区間ごとに，時間，処理したデータの大きさ，確保したメモリを記録する
+    # 無効の場合，profileで包んだ関数はそのまま呼ばれるだけなので，ほとんど遅くならない
+    def __init__(self):
+        self.enabled: bool = False
+        self.records: list = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.started_tracemalloc: bool = False
+
+    def enable(self, trace_memory: bool = True) -> None:
+        # trace_memoryの場合はtracemallocで確保したメモリも測る(処理は遅くなる)
+        # 別スレッドの処理と重なった場合，そちらで確保したメモリも含まれる
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracemalloc = True
+        self.enabled = True
+
+    def disable(self) -> None:
+        self.enabled = False
+        if self.started_tracemalloc:
+            tracemalloc.stop()
+            self.started_tracemalloc = False
+
+    def clear(self) -> None:
+        with self.lock:
+            self.records = []
+
+    def get_stack(self) -> list:
+        # 計測中の区間．スレッドごとに分ける
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def section(self, name: str, size=None):
+        if not self.enabled:
+            return nullcontext()
+        return Section(self, name, size)
+
+    def profile(self, name: str = None, size=None):
+        # 関数を計測区間にするデコレータ．sizeは関数と同じ引数をとり，処理したデータの大きさ[byte]を返す関数
+        def decorator(func):
+            section_name = func.__qualname__ if name is None else name
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                get_size = None if size is None else lambda: size(*args, **kwargs)
+                with Section(self, section_name, get_size):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def record(self, name: str, seconds: float, size: int = None, allocated: int = None, retained: int = None) -> None:
+        with self.lock:
+            self.records.append({
+                'name': name,
+                'thread': threading.current_thread().name,
+                'seconds': seconds,
+                'bytes': size,
+                'allocated_bytes': allocated,
+                'retained_bytes': retained,
+            })
+
+    def summarize(self) -> dict:
+        # 区間ごとに集計する．bytes, allocated_bytesは記録がなければNone
+        with self.lock:
+            records = list(self.records)
+        summary = {}
+        for r in records:
+            s = summary.setdefault(r['name'], {'calls': 0, 'total_seconds': 0.0, 'max_seconds': 0.0,
+                                               'total_bytes': None, 'max_allocated_bytes': None})
+            s['calls'] += 1
+            s['total_seconds'] += r['seconds']
+            s['max_seconds'] = max(s['max_seconds'], r['seconds'])
+            if r['bytes'] is not None:
+                s['total_bytes'] = (s['total_bytes'] or 0) + r['bytes']
+            if r['allocated_bytes'] is not None:
+                s['max_allocated_bytes'] = max(s['max_allocated_bytes'] or 0, r['allocated_bytes'])
+        for s in summary.values():
+            s['mean_seconds'] = s['total_seconds'] / s['calls']
+            s['megabytes_per_second'] = None
+            if s['total_bytes'] is not None and s['total_seconds'] > 0:
+                s['megabytes_per_second'] = s['total_bytes'] / s['total_seconds'] / 1024 ** 2
+        return summary
+
+    def format(self) -> str:
+        # 合計時間の長い順の表
+        summary = self.summarize()
+        lines = [f'{"name":<36}{"calls":>7}{"total [s]":>12}{"mean [s]":>12}{"max [s]":>12}{"MB/s":>10}{"alloc [MB]":>12}']
+        for name, s in sorted(summary.items(), key=lambda item: -item[1]['total_seconds']):
+            mbps = '' if s['megabytes_per_second'] is None else f'{s["megabytes_per_second"]:.1f}'
+            alloc = '' if s['max_allocated_bytes'] is None else f'{s["max_allocated_bytes"] / 1024 ** 2:.1f}'
+            lines.append(f'{name:<36}{s["calls"]:>7}{s["total_seconds"]:>12.4f}{s["mean_seconds"]:>12.4f}'
+                         f'{s["max_seconds"]:>12.4f}{mbps:>10}{alloc:>12}')
+        return '\n'.join(lines)
+
+    def dump(self, filename: str) -> None:
+        with self.lock:
+            records = list(self.records)
+        with open(filename, 'w') as f:
+            json.dump({'summary': self.summarize(), 'records': records}, f, indent=2)
+
+
+# アプリ全体で共有する．profiler.enable()で計測を始める
+profiler = Profiler()
+profile = profiler.profile
@@ -0,0 +1,139 @@
+import os
+import numpy as np
+from utils import FileReader, check_metadata, write_header, write_map, save_npz, load_npz
+
+
+def sort_xdata(xdata: np.ndarray, spectra: np.ndarray):
+    # 波長が降順の場合は昇順に並べ替える
+    if xdata.shape[0] > 1 and xdata[0] > xdata[-1]:
+        return xdata[::-1], spectra[:, ::-1]
+    return xdata, spectra
+
+
+def make_grid(xdata_list: list, step: float = None) -> np.ndarray:
+    # すべての窓を覆う等間隔の波長軸．間隔を指定しなければ，最も細かい窓の間隔の中央値
+    if step is None:
+        step = min(np.median(np.abs(np.diff(xdata))) for xdata in xdata_list)
+    start = min(xdata.min() for xdata in xdata_list)
+    stop = max(xdata.max() for xdata in xdata_list)
+    return start + np.arange(int(np.floor((stop - start) / step + 1e-9)) + 1) * step
+
+
+def get_weight(xdata: np.ndarray, grid: np.ndarray) -> np.ndarray:
+    # 窓の端からの距離．窓の外は0．重なった部分では，端に近い窓ほど小さくなる
+    weight = np.minimum(grid - xdata[0], xdata[-1] - grid)
+    weight[weight < 0] = 0
+    # 重なりのない端の点も使えるよう，窓の中では0にしない
+    inside = (xdata[0] <= grid) & (grid <= xdata[-1])
+    weight[inside] = np.maximum(weight[inside], np.finfo(float).tiny)
+    return weight
+
+
+def interpolate_rows(xdata: np.ndarray, spectra: np.ndarray, grid: np.ndarray) -> np.ndarray:
+    # すべてのスペクトルを一括で線形補間する．波長軸は共通なので，位置と重みは一度だけ計算する
+    grid = np.clip(grid, xdata[0], xdata[-1])
+    right = np.clip(np.searchsorted(xdata, grid), 1, xdata.shape[0] - 1)
+    left = right - 1
+    t = (grid - xdata[left]) / (xdata[right] - xdata[left])
+    return spectra[:, left] * (1 - t) + spectra[:, right] * t
+
+
+def stitch(xdata_list: list, spectra_list: list, mode: str = 'blend', grid: np.ndarray = None):
+    # 中心波長の異なる窓を，ひとつの単調な波長軸にまとめる
+    # blend: 重なった部分は窓の端に近いほど小さい重みで平均する．crop: 重なった部分の中央で切り替える
+    if mode not in ['blend', 'crop']:
+        raise ValueError(f'Unknown stitching mode: {mode}')
+    windows = [sort_xdata(xdata, spectra) for xdata, spectra in zip(xdata_list, spectra_list)]
+    if grid is None:
+        grid = make_grid([xdata for xdata, _ in windows])
+    weights = np.array([get_weight(xdata, grid) for xdata, _ in windows])
+    if mode == 'crop':
+        # 各点で最も窓の内側にある窓だけを使う
+        best = np.argmax(weights, axis=0)
+        weights = np.where(np.arange(len(windows))[:, np.newaxis] == best, weights, 0)
+    total_weight = weights.sum(axis=0)
+    covered = total_weight > 0
+    weights[:, covered] /= total_weight[covered]
+
+    stitched = np.zeros([windows[0][1].shape[0], grid.shape[0]])
+    for (xdata, spectra), weight in zip(windows, weights):
+        used = weight > 0
+        stitched[:, used] += interpolate_rows(xdata, spectra, grid[used]) * weight[used]
+    # どの窓にも含まれない隙間はNaN
+    stitched[:, ~covered] = np.nan
+    return grid, stitched
+
+
+class Stitcher:
+    # 校正・処理済みで保存したファイル(RayleighCalibrator.saveの出力)をつなげる
+    # 結果は入力(ファイルのパス・更新時刻・サイズ，処理)ごとに覚えておき，同じ組み合わせでは計算し直さない
+    def __init__(self, mode: str = 'blend', step: float = None, max_entries: int = 4):
+        self.mode: str = mode
+        self.step: float = step
+        self.max_entries: int = max_entries
+        self.results: dict = {}
+
+    def get_key(self, filenames: list, pipeline_key: tuple) -> tuple:
+        key = [self.mode, self.step, pipeline_key]
+        for filename in filenames:
+            stat = os.stat(filename)
+            key.append((os.path.abspath(filename), stat.st_mtime_ns, stat.st_size))
+        return tuple(key)
+
+    def stitch(self, filenames: list, pipeline_key: tuple = ()):
+        # (波長軸, スペクトル, 位置, ヘッダー)を返す．pipeline_keyは各ファイルを作った処理の設定
+        # 拡張子が.npzのファイルはsave_npzの形式で読む
+        key = self.get_key(filenames, pipeline_key)
+        if key in self.results:
+            return self.results[key]
+        readers = []
+        for filename in filenames:
+            if filename.endswith('.npz'):
+                reader = load_npz(filename)
+            else:
+                reader = FileReader()
+                reader.load(filename)
+            readers.append(reader)
+        check_metadata(readers)
+        xdata_list = [reader.xdata for reader in readers]
+        grid = make_grid(xdata_list, self.step)
+        xdata, spectra = stitch(xdata_list, [reader.spectra for reader in readers], self.mode, grid)
+        header = {
+            'abs_path_raw': ','.join(filenames),
+            'abs_path_bg': '',
+            'abs_path_ref': '',
+            'calibration': '',
+            'time': readers[0].time,
+            'integration': readers[0].integration,
+            'accumulation': readers[0].accumulation,
+            'interval': readers[0].interval,
+        }
+
+        # 古いものから捨てる
+        while len(self.results) >= self.max_entries:
+            del self.results[next(iter(self.results))]
+        self.results[key] = (xdata, spectra, readers[0].pos_arr, header)
+        return self.results[key]
+
+    def save(self, filenames: list, filename_to_save: str, pipeline_key: tuple = ()) -> None:
+        xdata, spectra, pos_arr, header = self.stitch(filenames, pipeline_key)
+        if filename_to_save.endswith('.npz'):
+            save_npz(filename_to_save, xdata, spectra, pos_arr, header)
+            return
+        with open(filename_to_save, 'w') as f:
+            write_header(f, header)
+            write_map(f, xdata, spectra, pos_arr)
+
+
+# stitch_filesで使う，(mode, step)ごとのStitcher
+stitchers: dict = {}
+
+
+def stitch_files(filenames: list, filename_to_save: str, mode: str = 'blend', step: float = None,
+                 pipeline_key: tuple = ()) -> None:
+    # 同じ設定の呼び出しではStitcherの結果を使い回す
+    key = (mode, step)
+    if key not in stitchers:
+        stitchers[key] = Stitcher(mode, step)
+    stitchers[key].save(filenames, filename_to_save, pipeline_key)
+
@@ -0,0 +1,62 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from cache import FileCache, CalibrationCache
+from utils import FileReader
+from benchmark.synthetic import generate_map, write_ras
+
+
+def write_map_file(filename: str, seed: int) -> str:
+    xdata, spectra, pos_arr, _ = generate_map(num_pos=8, num_pixel=64, accumulation=2, seed=seed)
+    write_ras(filename, xdata, spectra, pos_arr, 2)
+    return filename
+
+
+def test_evict_keeps_open_entries(tmp_path):
+    # 上限を超えても，メモリマップで開いているエントリは削除しない
+    cache = FileCache(str(tmp_path / 'cache'), max_bytes=0)
+    raw = write_map_file(str(tmp_path / 'raw.txt'), 0)
+    bg = write_map_file(str(tmp_path / 'bg.txt'), 1)
+    reader_raw = FileReader(cache, lazy=True)
+    reader_raw.load(raw)
+    FileReader(cache).load(bg)
+    assert os.path.isdir(cache.get_entry(raw))
+    assert reader_raw.spectra.sum() > 0
+
+    # 別のファイルを読み込めば，前のエントリは削除してよい
+    reader_raw.load(bg)
+    cache.evict()
+    assert not os.path.isdir(cache.get_entry(raw))
+
+
+def load_shared(directory: str, filename: str) -> float:
+    reader = FileReader(FileCache(directory, max_bytes=0))
+    reader.load(filename)
+    return float(reader.spectra.sum())
+
+
+def test_shared_between_processes(tmp_path):
+    # batch --workersのように，複数のプロセスが同じキャッシュに同じファイルを同時に読み込んでも失敗しない
+    directory = str(tmp_path / 'cache')
+    filenames = [write_map_file(str(tmp_path / f'map{i}.txt'), i) for i in range(2)]
+    expected = [load_shared(str(tmp_path / 'reference'), filename) for filename in filenames]
+    with ProcessPoolExecutor(max_workers=8) as executor:
+        for _ in range(5):
+            FileCache(directory).clear()
+            futures = [executor.submit(load_shared, directory, filenames[i % 2]) for i in range(32)]
+            assert [future.result() for future in futures] == [expected[i % 2] for i in range(32)]
+
+
+def save_and_load_calibration(directory: str, i: int) -> bool:
+    # 他のプロセスが消したエントリは読めなくてもよいが，例外にはならない
+    cache = CalibrationCache(directory, max_entries=1)
+    key = str(i % 4)
+    cache.save(key, np.arange(i, i + 8, dtype=float), {'index': i})
+    cached = cache.load(key)
+    return cached is None or cached[0][0] % 4 == i % 4
+
+
+def test_calibration_cache_shared_between_processes(tmp_path):
+    directory = str(tmp_path / 'calibrations')
+    with ProcessPoolExecutor(max_workers=8) as executor:
+        assert all(executor.map(save_and_load_calibration, [directory] * 64, range(64)))
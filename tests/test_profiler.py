@@ -0,0 +1,31 @@
+import os
+import pytest
+from profiler import Profiler
+
+
+def test_size_not_called_on_error(tmp_path):
+    # 区間内の例外がsizeの関数(存在しないファイルの大きさなど)の例外で隠されない
+    profiler = Profiler()
+    profiler.enable(trace_memory=False)
+    filename = str(tmp_path / 'missing.txt')
+
+    @profiler.profile(size=lambda filename: os.path.getsize(filename))
+    def save(filename):
+        raise ValueError('not saved')
+
+    with pytest.raises(ValueError, match='not saved'):
+        save(filename)
+    assert profiler.records[0]['bytes'] is None
+
+
+def test_size_recorded(tmp_path):
+    profiler = Profiler()
+    profiler.enable(trace_memory=False)
+
+    @profiler.profile(size=lambda filename: os.path.getsize(filename))
+    def save(filename):
+        with open(filename, 'w') as f:
+            f.write('0123456789')
+
+    save(str(tmp_path / 'saved.txt'))
+    assert profiler.records[0]['bytes'] == 10
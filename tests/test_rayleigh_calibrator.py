@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+from RayleighCalibrator import RayleighCalibrator
+from benchmark.synthetic import generate_map, write_ras
+
+
+@pytest.fixture
+def calibrator(tmp_path):
+    xdata, spectra, pos_arr, _ = generate_map(num_pos=8, num_pixel=128, accumulation=2)
+    filename = str(tmp_path / 'map.txt')
+    write_ras(filename, xdata, spectra, pos_arr, 2)
+    calibrator = RayleighCalibrator()
+    calibrator.load_raw(filename)
+    return calibrator
+
+
+def test_peak_parameters_follow_pipeline(calibrator):
+    # 処理を変えると，前の処理でフィットした結果は使わない．処理を戻せばキャッシュした結果に戻る
+    band = [calibrator.xdata[40], calibrator.xdata[90]]
+    calibrator.process()
+    fitted = calibrator.fit_peaks(band)
+    assert calibrator.peak_parameters is fitted
+
+    calibrator.process(cosmic_ray=True)
+    assert calibrator.peak_parameters is None
+    with pytest.raises(ValueError):
+        calibrator.get_map_values(band, 'center')
+
+    calibrator.process()
+    assert calibrator.peak_parameters is fitted
+
+
+def test_fit_peaks_parallel(calibrator):
+    # 並列にフィットしても結果は同じ
+    band = [calibrator.xdata[40], calibrator.xdata[90]]
+    calibrator.process()
+    serial = calibrator.fit_peaks(band)
+    calibrator.fit_cache = {}
+    calibrator.set_executor(2, chunk_size=3)
+    try:
+        parallel = calibrator.fit_peaks(band)
+    finally:
+        calibrator.set_executor(0)
+    for name in serial:
+        np.testing.assert_array_equal(parallel[name], serial[name])
+
+
+def test_band_intensity(calibrator):
+    # 処理していなければ生データの和，処理後は処理したデータの和．同じ処理・範囲は計算し直さない
+    band = [calibrator.xdata[40], calibrator.xdata[90]]
+    start, stop = calibrator.get_band_range(*band)
+    calibrator.process()
+    raw = calibrator.get_band_intensity(*band)
+    np.testing.assert_allclose(raw, calibrator.reader_raw.spectra_accumulated[:, start:stop].sum(axis=1))
+    assert calibrator.get_band_intensity(*band) is raw
+
+    calibrator.process(cosmic_ray=True, smoothing=True)
+    processed = calibrator.get_band_intensity(*band)
+    np.testing.assert_allclose(processed, calibrator.map_data_accumulated[:, start:stop].sum(axis=1))
+    assert calibrator.get_map_values(band) is processed
+
+    calibrator.process()
+    assert calibrator.get_band_intensity(*band) is raw
+
+
+def test_color_range(calibrator):
+    # 読み込み時の要約から求めた範囲はマップ全体の最小・最大と同じ
+    data = calibrator.reader_raw.spectra_accumulated
+    assert calibrator.get_color_range() == [data.min(), data.max()]
@@ -0,0 +1,45 @@
+import numpy as np
+from utils import save_npz, load_npz
+from stitch import Stitcher, stitch_files
+
+
+def make_window(center: float, num_pixel: int = 64):
+    xdata = np.linspace(center - 67, center + 67, num_pixel)
+    spectra = np.tile(xdata, (4, 1))
+    pos_arr = np.repeat(np.arange(6, dtype=float).reshape(2, 3), 2, axis=0)
+    header = {'time': '2023-05-11 12:00:00', 'integration': 1.0, 'accumulation': 2, 'interval': 0.5}
+    return xdata, spectra, pos_arr, header
+
+
+def test_stitch_npz_files(tmp_path):
+    # .npzで保存した処理済みのマップもつなげられる
+    filenames = []
+    for center in [500, 630]:
+        filename = str(tmp_path / f'{center}.npz')
+        save_npz(filename, *make_window(center))
+        filenames.append(filename)
+    stitch_files(filenames, str(tmp_path / 'stitched.npz'))
+
+    reader = load_npz(str(tmp_path / 'stitched.npz'))
+    assert np.all(np.diff(reader.xdata) > 0)
+    assert reader.xdata[0] == 433 and reader.xdata[-1] <= 697
+    # スペクトルは波長そのものなので，つなげた後も波長と一致する
+    np.testing.assert_allclose(reader.spectra, np.tile(reader.xdata, (4, 1)))
+    assert reader.accumulation == 2 and reader.integration == 1.0
+
+
+def test_stitch_reuses_result(tmp_path):
+    # 同じファイル・設定でつなげ直すと前回の結果を使い，ファイルが変わると計算し直す
+    filenames = []
+    for center in [500, 630]:
+        filename = str(tmp_path / f'{center}.npz')
+        save_npz(filename, *make_window(center))
+        filenames.append(filename)
+    stitcher = Stitcher()
+    first = stitcher.stitch(filenames, pipeline_key=('smooth',))
+    assert stitcher.stitch(filenames, pipeline_key=('smooth',)) is first
+    assert stitcher.stitch(filenames, pipeline_key=()) is not first
+
+    xdata, spectra, pos_arr, header = make_window(630, num_pixel=32)
+    save_npz(filenames[1], xdata, spectra, pos_arr, header)
+    assert stitcher.stitch(filenames, pipeline_key=('smooth',)) is not first
@@ -0,0 +1,105 @@
+import numpy as np
+import pytest
+from utils import remove_cosmic_ray, remove_cosmic_ray_1d, smooth, smooth_1d, get_grid_step, make_position_grid, summarize_spectra
+
+
+def make_spectra(num_spectra: int, num_pixel: int, seed: int = 0) -> np.ndarray:
+    # ノイズにところどころスパイクを足したスペクトル
+    rng = np.random.default_rng(seed)
+    spectra = rng.normal(1000, 10, [num_spectra, num_pixel])
+    spikes = rng.random([num_spectra, num_pixel]) < 0.02
+    spectra[spikes] += rng.uniform(500, 5000, spikes.sum())
+    return spectra
+
+
+@pytest.mark.parametrize('num_pixel', [2, 3, 5, 8, 64, 1024])
+@pytest.mark.parametrize('width', [0, 1, 3, 5, 7, 100])
+@pytest.mark.parametrize('threshold', [3, 7])
+def test_remove_cosmic_ray_matches_1d(num_pixel, width, threshold):
+    # 一括処理の結果は1スペクトルずつ処理した場合と一致する．窓が画素数より広い場合も含む
+    spectra = make_spectra(20, num_pixel)
+    expected = np.array([remove_cosmic_ray_1d(spectrum, width, threshold) for spectrum in spectra])
+    np.testing.assert_allclose(remove_cosmic_ray(spectra, width, threshold), expected, rtol=1e-12)
+
+
+def test_remove_cosmic_ray_wide_window():
+    spectra = np.random.default_rng(0).random([3, 5])
+    expected = np.array([remove_cosmic_ray_1d(spectrum, 5, 7) for spectrum in spectra])
+    np.testing.assert_allclose(remove_cosmic_ray(spectra, 5, 7), expected, rtol=1e-12)
+
+
+def test_remove_cosmic_ray_1d_input_and_out():
+    spectra = make_spectra(4, 256)
+    expected = remove_cosmic_ray_1d(spectra[0], 3, 7)
+    np.testing.assert_allclose(remove_cosmic_ray(spectra[0], 3, 7), expected, rtol=1e-12)
+    # outに入力自身を指定しても結果は変わらない
+    out = spectra.copy()
+    remove_cosmic_ray(out, 3, 7, out=out)
+    np.testing.assert_allclose(out, np.array([remove_cosmic_ray_1d(spectrum, 3, 7) for spectrum in spectra]), rtol=1e-12)
+
+
+@pytest.mark.parametrize('num_pixel', [1, 2, 5, 49, 50, 64, 1024])
+@pytest.mark.parametrize('width', [1, 2, 7, 100, 101])
+def test_smooth_matches_1d(num_pixel, width):
+    # 一括処理の結果は1スペクトルずつ処理した場合と一致する．延長する数が画素数より多い場合も含む
+    spectra = make_spectra(20, num_pixel)
+    expected = np.array([smooth_1d(spectrum, width) for spectrum in spectra])
+    np.testing.assert_allclose(smooth(spectra, width), expected, rtol=1e-9)
+
+
+def test_smooth_float32_and_out():
+    spectra = make_spectra(4, 256)
+    expected = np.array([smooth_1d(spectrum, 100) for spectrum in spectra])
+    # float32の場合も和はfloat64で計算するので，誤差は丸めの分だけ
+    np.testing.assert_allclose(smooth(spectra.astype(np.float32), 100), expected, rtol=1e-6)
+    out = spectra.copy()
+    smooth(out, 100, out=out)
+    np.testing.assert_allclose(out, expected, rtol=1e-9)
+
+
+def make_scan(x: np.ndarray, y: np.ndarray, jitter: float, seed: int = 0) -> np.ndarray:
+    # x, yの格子を走査した位置．ステージの位置のばらつきjitterを加える
+    rng = np.random.default_rng(seed)
+    xx, yy = np.meshgrid(x, y)
+    pos_arr = np.stack([xx.ravel(), yy.ravel(), np.zeros(xx.size)], axis=1)
+    pos_arr[:, :2] += rng.normal(0, jitter, [xx.size, 2])
+    return pos_arr
+
+
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('x, y', [
+    (np.array([0, 1, 2, 4, 5, 6]), np.arange(4)),  # 1列抜けた走査
+    (np.array([0, 1, 2, 3]), np.array([0, 1, 3, 4, 5])),  # 1行抜けた走査
+    (np.append(np.arange(5), 50 + np.arange(5)) * 2.5, np.arange(3) * 2.5),  # 離れた2つの領域
+])
+def test_position_grid_with_gaps(x, y, seed):
+    # 列や行が抜けていても，すべての位置が別々の格子点に入り，クリックした格子点の位置が選ばれる
+    pos_arr = make_scan(x, y, jitter=0.02, seed=seed)
+    grid = make_position_grid(pos_arr)
+    assert np.count_nonzero(grid['index'] >= 0) == pos_arr.shape[0]
+    np.testing.assert_array_equal(grid['index'][grid['row'], grid['col']], np.arange(pos_arr.shape[0]))
+    col, row = np.rint((pos_arr[:, :2] - grid['origin']) / grid['step']).astype(int).T
+    np.testing.assert_array_equal(grid['index'][row, col], np.arange(pos_arr.shape[0]))
+
+
+def test_get_grid_step():
+    assert get_grid_step(np.array([0, 1, 2, 3, 7])) == pytest.approx(1)
+    assert get_grid_step(np.arange(20) * 0.1) == pytest.approx(0.1)
+    assert get_grid_step(np.array([5.0])) == 1.0
+
+
+def test_position_grid_duplicates():
+    # 同じ格子点に入る位置があれば，黙って上書きせずにエラーにする
+    pos_arr = make_scan(np.arange(3), np.arange(3), jitter=0)
+    with pytest.raises(ValueError):
+        make_position_grid(np.concatenate([pos_arr, pos_arr[:1]]))
+
+
+def test_summarize_spectra_chunks():
+    # 行ごとに分けて計算しても，一括で計算した場合と同じ
+    spectra = make_spectra(10, 32)
+    summary = summarize_spectra(spectra, chunk=3)
+    np.testing.assert_array_equal(summary['min'], spectra.min(axis=1))
+    np.testing.assert_array_equal(summary['max'], spectra.max(axis=1))
+    np.testing.assert_allclose(summary['sum'], spectra.sum(axis=1))
+    np.testing.assert_array_equal(summary['peak_index'], spectra.argmax(axis=1))
@@ -0,0 +1,35 @@
+import os
+import argparse
+from batch import add_job_arguments
+from watch import FolderWatcher
+
+
+def make_watcher(folder: str) -> FolderWatcher:
+    parser = argparse.ArgumentParser()
+    add_job_arguments(parser)
+    args = parser.parse_args(['--output', os.path.join(folder, 'processed')])
+    return FolderWatcher(folder, args)
+
+
+def write(filename: str, text: str, mtime_ns: int) -> None:
+    with open(filename, 'w') as f:
+        f.write(text)
+    os.utime(filename, ns=(mtime_ns, mtime_ns))
+
+
+def test_rewritten_file_must_settle_again(tmp_path):
+    # 書き込み済みとみなしたファイルが書き換えられたら，また変わらなくなるまで使わない
+    filename = str(tmp_path / 'map.txt')
+    watcher = make_watcher(str(tmp_path))
+    write(filename, 'first', 10 ** 18)
+    watcher.scan()
+    assert filename not in watcher.files
+    watcher.scan()
+    assert filename in watcher.files
+
+    write(filename, 'first and more', 2 * 10 ** 18)
+    watcher.scan()
+    assert filename not in watcher.files
+    watcher.scan()
+    assert watcher.files[filename][2] == 2 * 10 ** 18
+    assert not watcher.is_processed(filename)
@@ -1,6 +1,10 @@
+import os
+import json
+import itertools
 import numpy as np
-import pandas as pd
-from dataloader.DataLoader import find_skip, extract_keyword
+from dataloader.DataLoader import extract_keyword
+from cache import FileCache
+from profiler import profile
 
 
 def remove_cosmic_ray_1d(spectrum: np.ndarray, width: int, threshold: float):
@@ -23,15 +27,48 @@ def remove_cosmic_ray_1d(spectrum: np.ndarray, width: int, threshold: float):
     return spectrum
 
 
-def remove_cosmic_ray(spectrum: np.ndarray, width: int = 3, threshold: float = 7):
+def remove_cosmic_ray_2d(spectra: np.ndarray, width: int, threshold: float, out: np.ndarray = None):
+    # remove_cosmic_ray_1dを全スペクトルに対して一括で行う．結果は1スペクトルずつ処理した場合と一致する
+    # outを指定すると新しい配列を作らずにそこへ書き込む(spectra自身でもよい)
+    if out is None:
+        out = spectra.copy()
+    elif out is not spectra:
+        out[...] = spectra
+    if spectra.shape[0] == 0:
+        return out
+    intensity = np.diff(spectra, axis=1)
+    median_int = np.median(intensity, axis=1, keepdims=True)
+    mad_int = np.median(np.abs(intensity - median_int), axis=1, keepdims=True)
+    mad_int[mad_int == 0] = 1e-4
+    modified_scores = 0.6745 * (intensity - median_int) / mad_int
+    spikes = abs(modified_scores) > threshold
+    not_spikes = ~spikes
+
+    # スパイク周りの2 m + 1個のうちスパイクでない値の和と個数を，窓をずらしながら足し合わせる
+    # 左から順に足すので，np.meanと同じ順序で和を取ることになる
+    num = spikes.shape[1]
+    total = np.zeros(spikes.shape)
+    count = np.zeros(spikes.shape, dtype=int)
+    for shift in range(-width, width + 1):
+        # 全体より大きくずらした窓は範囲外なので足さない(スライスの端が負になると反対側から数えてしまう)
+        if abs(shift) >= num:
+            continue
+        dst = slice(max(0, -shift), min(num, num - shift))
+        src = slice(dst.start + shift, dst.stop + shift)
+        total[:, dst] += np.where(not_spikes[:, src], spectra[:, src], 0)
+        count[:, dst] += not_spikes[:, src]
+
+    to_replace = spikes & (count > 0)
+    out[:, :num][to_replace] = total[to_replace] / count[to_replace]  # 平均を計算し補完
+    return out
+
+
+def remove_cosmic_ray(spectrum: np.ndarray, width: int = 3, threshold: float = 7, out: np.ndarray = None):
     if len(spectrum.shape) == 1:
-        return remove_cosmic_ray_1d(spectrum, width, threshold)
+        return remove_cosmic_ray_2d(spectrum[np.newaxis], width, threshold, None if out is None else out[np.newaxis])[0]
 
     if len(spectrum.shape) == 2:
-        data_removed = []
-        for spec in spectrum:
-            data_removed.append(remove_cosmic_ray_1d(spec, width, threshold))
-        return np.array(data_removed)
+        return remove_cosmic_ray_2d(spectrum, width, threshold, out)
 
 
 def smooth_1d(spectrum, width):
@@ -44,15 +81,57 @@ def smooth_1d(spectrum, width):
     return spectrum_smoothed[num_front:-num_back]
 
 
-def smooth(spectrum, width):
+def smooth_2d(spectra, width, out: np.ndarray = None):
+    # smooth_1dと同じ端の処理(端からの累積平均で延長)をした移動平均を，累積和で全スペクトル一括に計算する
+    # outを指定すると新しい配列を作らずにそこへ書き込む(spectra自身でもよい)
+    num_spectra, num_pixel = spectra.shape
+    num_front = width // 2
+    num_back = width // 2 + 1 if width % 2 else width // 2
+    divisor_front = np.arange(1, num_front + 1)
+    divisor_back = np.arange(1, num_back + 1)
+
+    # 先頭に0を置いた延長スペクトルの累積和をひとつの配列上で作る
+    # 延長する数が画素数より多い場合，端からの平均は画素数を超えたところでスペクトル全体の平均のままになる
+    cumsum = np.zeros([num_spectra, 1 + num_front + num_pixel + num_back])
+    if num_pixel > 0:
+        front = min(num_front, num_pixel)
+        back = min(num_back, num_pixel)
+        start_back = 1 + num_front + num_pixel
+        cumsum[:, 1:1 + front] = np.cumsum(spectra[:, :front], axis=1) / divisor_front[:front]
+        cumsum[:, 1 + front:1 + num_front] = cumsum[:, front:front + 1]
+        cumsum[:, 1 + num_front:start_back] = spectra
+        cumsum[:, start_back:start_back + back] = np.cumsum(spectra[:, ::-1][:, :back], axis=1) / divisor_back[:back]
+        cumsum[:, start_back + back:] = cumsum[:, start_back + back - 1:start_back + back]
+    np.cumsum(cumsum, axis=1, out=cumsum)
+
+    # 累積和は桁落ちしないようfloat64で計算し，入力の型(float32など)で書き込む
+    if out is None:
+        out = np.empty(spectra.shape, dtype=spectra.dtype)
+    np.divide(cumsum[:, width:width + num_pixel] - cumsum[:, :num_pixel], width, out=out)
+    return out
+
+
+def smooth(spectrum, width, out: np.ndarray = None):
     if len(spectrum.shape) == 1:
-        return smooth_1d(spectrum, width)
+        return smooth_2d(spectrum[np.newaxis], width, None if out is None else out[np.newaxis])[0]
 
     if len(spectrum.shape) == 2:
-        spectrum_smoothed = []
-        for s in spectrum:
-            spectrum_smoothed.append(smooth_1d(s, width))
-        return np.array(spectrum_smoothed)
+        return smooth_2d(spectrum, width, out)
+
+
+def downsample(data: np.ndarray, max_rows: int, max_cols: int):
+    # 表示用に，行・列の数がmax_rows, max_cols以下になるようブロックごとの平均をとる
+    num_rows, num_cols = data.shape
+    factor_rows = int(np.ceil(num_rows / max_rows))
+    factor_cols = int(np.ceil(num_cols / max_cols))
+    if factor_rows <= 1 and factor_cols <= 1:
+        return data
+    starts_rows = np.arange(0, num_rows, factor_rows)
+    starts_cols = np.arange(0, num_cols, factor_cols)
+    summed = np.add.reduceat(np.add.reduceat(data, starts_rows, axis=0), starts_cols, axis=1)
+    counts_rows = np.diff(np.append(starts_rows, num_rows))
+    counts_cols = np.diff(np.append(starts_cols, num_cols))
+    return summed / np.outer(counts_rows, counts_cols)
 
 
 def process_interval_and_num_pos(value_str):
@@ -73,8 +152,56 @@ def process_interval_and_num_pos(value_str):
     return value, use_this
 
 
+def read_header(f):
+    # pos_xの行までをヘッダーとして読み，続くpos_x, pos_y, pos_zの行から座標を取り出す
+    # ファイルオブジェクトは波長とスペクトルの数値ブロックの先頭まで進んだ状態になる
+    # f.tell()を使えるよう，イテレータではなくreadlineで読む
+    header = []
+    while True:
+        line = f.readline()
+        if not line:
+            raise ValueError('No position data found.')
+        if line.startswith('pos_x'):
+            break
+        header.append(line)
+    pos_lines = [line, f.readline(), f.readline()]
+    pos_arr = np.array([line.split(',')[1:] for line in pos_lines], dtype=float).T
+    return header, pos_arr
+
+
+def is_data_line(line):
+    return line.strip() != '' and not line.startswith('#')
+
+
+def read_blocks(f, num_rows: int):
+    # 数値ブロックをnum_rows行ずつ読み，(行数, 1 + スペクトル数)の配列として返す
+    while True:
+        lines = list(itertools.islice(f, num_rows))
+        if not lines:
+            return
+        lines = [line for line in lines if is_data_line(line)]
+        if lines:
+            yield np.loadtxt(lines, delimiter=',', ndmin=2)
+
+
 class FileReader:
-    def __init__(self):
+    # キャッシュに保存する配列とヘッダー．スペクトルはメモリマップで開く
+    cached_arrays = ['pos_arr', 'pos_arr_relative_accumulated', 'pos_arr_absolute_accumulated',
+                     'xdata', 'spectra', 'spectra_accumulated']
+    cached_arrays_mmap = ['spectra', 'spectra_accumulated']
+    cached_header = ['time', 'integration', 'accumulation', 'use_interval', 'interval', 'use_num_pos', 'num_pos', 'dtype']
+
+    # 数値ブロックを読み込む際，一度に扱うブロックの大きさ[byte]
+    # テキストの行のリストが一時的に数倍の大きさになるので，小さめにしておく
+    block_bytes = 2 ** 22
+
+    def __init__(self, cache: FileCache = None, lazy: bool = False, dtype: str = 'float64'):
+        self.cache = cache
+        # Trueの場合，スペクトルをメモリに読み込まず，キャッシュ上のメモリマップ(読み取り専用)として扱う
+        self.lazy = lazy
+        # スペクトル(積算前後)を保持する型．float32にするとメモリと読み書きの量が半分になる
+        # 波長と座標は校正の精度に関わるので常にfloat64
+        self.dtype: str = np.dtype(dtype).name
         self.filename: str = ''
         self.time: str = ''
         self.integration: float = 0
@@ -83,7 +210,6 @@ class FileReader:
         self.interval: float = 0
         self.use_num_pos: bool = False
         self.num_pos: int = 0
-        self.df: pd.DataFrame = pd.DataFrame()
 
         self.pos_arr: np.ndarray = None
         self.pos_arr_relative_accumulated: np.ndarray = None
@@ -91,6 +217,12 @@ class FileReader:
         self.xdata: np.ndarray = None
         self.spectra: np.ndarray = None
         self.spectra_accumulated: np.ndarray = None
+        # 積算後のスペクトルごとの最小・最大・合計・ピーク位置．キャッシュに一緒に保存する
+        self.summary: dict = None
+        # 波長帯ごとの積分強度．キーは画素の範囲
+        self.band_intensity: dict = {}
+        # メモリマップで開いているキャッシュのファイル名．開いている間はキャッシュから削除されない
+        self.pinned_filename: str = None
 
     def __str__(self):
         return f'filename: {self.filename}\n' \
@@ -99,100 +231,350 @@ class FileReader:
                f'accumulation: {self.accumulation}\n' \
                f'interval: {self.interval}\n' \
                f'num_pos: {self.num_pos}\n' \
-               f'data:\n{self.df}' \
+               f'spectra: {None if self.spectra is None else self.spectra.shape}'
 
 
+    @profile(size=lambda self, filename: os.path.getsize(filename))
     def load(self, filename):
+        self.unpin_cache()
         self.filename = filename
+        self.band_intensity = {}
+        if self.load_cache():
+            return
+        if self.lazy:
+            self.load_lazy()
+            return
+
+        # 数値ブロックは少しずつ読み，最終的な形と型で確保した配列に直接書き込む(ファイル全体のfloat64の一時配列を作らない)
         with open(filename, 'r') as f:
-            lines = f.readlines()
-        self.df = pd.read_csv(filename, skiprows=find_skip(lines) - 3, header=None, index_col=0)
-        self.time = extract_keyword(lines, 'time')
-        self.integration = float(extract_keyword(lines, 'integration'))
-        self.accumulation = int(extract_keyword(lines, 'accumulation'))
-        # RASのバージョンによって変わる．．．最悪
-        self.interval, self.use_interval = process_interval_and_num_pos(extract_keyword(lines, 'interval'))
-        self.num_pos, self.use_num_pos = process_interval_and_num_pos(extract_keyword(lines, 'num_pos'))
-
-        self.pos_arr = self.df.loc['pos_x':'pos_z'].values.T
-        self.xdata = self.df.index[3:].values.astype(float)
-        self.spectra = self.df.iloc[3:].values.astype(float).T
+            header, self.pos_arr = read_header(f)
+            self.set_header(header)
+            self.read_data(f, lambda shape: np.empty(shape, dtype=self.dtype))
 
         self.accumulate()
-
-    def accumulate(self):
-        spectra_accumulated = np.empty([0, self.xdata.shape[0]])
-        pos_arr_rel_acc = []
-        pos_arr_abs_acc = []
-
-        tmp_accumulated = np.zeros(self.xdata.shape[0])
-        pos_origin = self.pos_arr[0]
-        pos_check = self.pos_arr[0]
-
-        for i, (pos, spec) in enumerate(zip(self.pos_arr, self.spectra)):
-            # if self.pos_arr[i].all() == np.zeros(3).all():  # なぜ起きた？
-            #     print(f'Warning: skip dangerous data {i}')
-            #     continue
-            if i % self.accumulation == 0:
-                pos_check = self.pos_arr[i]
-            else:
-                if pos.any() != pos_check.any():
-                    print(f'{i}: {pos}, {pos_check}')
-                    raise ValueError('Spectra were got at different positions.')
-            tmp_accumulated += spec
-
-            if i % self.accumulation == self.accumulation - 1:
-                spectra_accumulated = np.append(spectra_accumulated, tmp_accumulated.reshape([1, self.xdata.shape[0]]), axis=0)
-                pos_arr_rel_acc.append(pos_check - pos_origin)
-                pos_arr_abs_acc.append(pos_check)
-                tmp_accumulated = np.zeros(self.xdata.shape[0])
-
-        self.pos_arr_relative_accumulated = np.array(pos_arr_rel_acc)
-        self.pos_arr_absolute_accumulated = np.array(pos_arr_abs_acc)
-        self.spectra_accumulated = spectra_accumulated
-
-
-def concat(filenames, filename_to_save):
-    fr = FileReader()
-
-    fr_list = []
-    for filename in filenames:
-        fr_tmp = FileReader()
-        fr_tmp.load(filename)
-        fr_list.append(fr_tmp)
-        # TODO: check if metadata matches
-
-    fr.filename = ','.join(filenames)
-    fr.integration = fr_list[0].integration
-    fr.accumulation = fr_list[0].accumulation
-    fr.interval = fr_list[0].interval
-
-    fr.pos_arr = fr_list[0].pos_arr
-    fr.pos_arr_relative_accumulated = fr_list[0].pos_arr_relative_accumulated
-    fr.xdata = np.hstack([f.xdata for f in fr_list])
-    fr.spectra = np.hstack([f.spectra for f in fr_list])
-    fr.spectra_accumulated = np.hstack([f.spectra_accumulated for f in fr_list])
-
-    pos_data = fr.pos_arr
-    pos_data = np.vstack([np.array(['pos_x', 'pos_y', 'pos_z']), pos_data]).T.astype(str)
-
-    xdata = np.array(fr.xdata)
-    map_data = fr.spectra
-    map_data = np.vstack([xdata, map_data]).T.astype(str)
-
-    data = np.vstack([pos_data, map_data])
-
-    with open(filename_to_save, 'w') as f:
-        f.write(f'# abs_path_raw: {fr.filename}\n')
-        f.write(f'# abs_path_bg: \n')
-        f.write(f'# abs_path_ref: \n')
-        f.write(f'# calibration: \n')
-        f.write(f'# time: \n')
-        f.write(f'# integration: {fr.integration}\n')
-        f.write(f'# accumulation: {fr.accumulation}\n')
-        f.write(f'# interval: {fr.interval}\n')
-        for d in data:
-            f.write(','.join(d) + '\n')
+        self.save_cache()
+
+    def load_lazy(self):
+        # RAMに載らないファイルのために，数値ブロックを少しずつキャッシュ上のメモリマップに書き込む
+        if self.cache is None:
+            raise ValueError('Lazy loading requires a cache.')
+        with open(self.filename, 'r') as f:
+            header, self.pos_arr = read_header(f)
+            self.set_header(header)
+            self.cache.begin(self.filename)
+            self.read_data(f, lambda shape: self.cache.create_array(self.filename, 'spectra', shape, self.dtype))
+
+        num_spectra, num_pixel = self.spectra.shape
+        num_pos = num_spectra // self.accumulation
+        spectra_accumulated = self.cache.create_array(self.filename, 'spectra_accumulated', (num_pos, num_pixel), self.dtype)
+        self.accumulate(out=spectra_accumulated, chunk=max(1, self.block_bytes // (8 * self.accumulation * num_pixel)))
+
+        # 書き込み用のメモリマップを閉じてから確定し，読み取り専用で開き直す
+        self.spectra.flush()
+        self.spectra_accumulated.flush()
+        self.spectra = self.spectra_accumulated = None
+        del spectra_accumulated
+        arrays = {name: arr for name, arr in self.get_cached_arrays().items() if name not in self.cached_arrays_mmap}
+        header = {name: getattr(self, name) for name in self.cached_header}
+        self.cache.commit(self.filename, arrays, header)
+        if not self.load_cache():
+            raise ValueError('Failed to save the cache.')
+
+    def read_data(self, f, create) -> None:
+        # ヘッダーの後の数値ブロックをblock_bytes程度ずつ読み，波長をxdataに，スペクトルをcreate(形)で作った配列に書き込む
+        # 書き込み先の大きさを決めるため，先に数値ブロックの行数だけ数える
+        offset = f.tell()
+        num_pixel = sum(1 for line in f if is_data_line(line))
+        f.seek(offset)
+
+        num_spectra = self.pos_arr.shape[0]
+        self.xdata = np.empty(num_pixel)
+        self.spectra = create((num_spectra, num_pixel))
+        start = 0
+        for block in read_blocks(f, max(1, self.block_bytes // (8 * max(num_spectra, 1)))):
+            stop = start + block.shape[0]
+            self.xdata[start:stop] = block[:, 0]
+            self.spectra[:, start:stop] = block[:, 1:].T
+            start = stop
+
+    def set_header(self, header):
+        self.time = extract_keyword(header, 'time')
+        self.integration = float(extract_keyword(header, 'integration'))
+        self.accumulation = int(extract_keyword(header, 'accumulation'))
+        # RASのバージョンによって変わる．．．最悪
+        self.interval, self.use_interval = process_interval_and_num_pos(extract_keyword(header, 'interval'))
+        self.num_pos, self.use_num_pos = process_interval_and_num_pos(extract_keyword(header, 'num_pos'))
+
+    def load_cache(self) -> bool:
+        if self.cache is None:
+            return False
+        cached = self.cache.load(self.filename, mmap=self.cached_arrays_mmap)
+        if cached is None:
+            return False
+        arrays, header = cached
+        # 違う型で保存されている場合は読み込み直して上書きする
+        if header['dtype'] != self.dtype:
+            return False
+        for name in self.cached_arrays:
+            setattr(self, name, arrays[name])
+        self.summary = {name[len('summary_'):]: arr for name, arr in arrays.items() if name.startswith('summary_')}
+        for name in self.cached_header:
+            setattr(self, name, header[name])
+        self.cache.pin(self.filename)
+        self.pinned_filename = self.filename
+        return True
+
+    def unpin_cache(self) -> None:
+        # 前に読み込んだファイルのキャッシュを削除してよいことにする
+        if self.pinned_filename is not None:
+            self.cache.unpin(self.pinned_filename)
+            self.pinned_filename = None
+
+    def save_cache(self) -> None:
+        if self.cache is None:
+            return
+        header = {name: getattr(self, name) for name in self.cached_header}
+        self.cache.save(self.filename, self.get_cached_arrays(), header)
+
+    def get_cached_arrays(self) -> dict:
+        arrays = {name: getattr(self, name) for name in self.cached_arrays}
+        arrays.update({f'summary_{name}': arr for name, arr in self.summary.items()})
+        return arrays
+
+    def invalidate_cache(self, filename: str = None) -> None:
+        # filenameを省略した場合は読み込み中のファイルのキャッシュを削除
+        if self.cache is None:
+            return
+        self.cache.invalidate(self.filename if filename is None else filename)
+
+    @profile(size=lambda self, *args, **kwargs: self.spectra.nbytes)
+    def accumulate(self, out: np.ndarray = None, chunk: int = None):
+        num_pos = self.spectra.shape[0] // self.accumulation
+        num_used = num_pos * self.accumulation
+
+        check_positions(self.pos_arr, self.accumulation)
+        self.pos_arr_absolute_accumulated = self.pos_arr[:num_used:self.accumulation].copy()
+        self.pos_arr_relative_accumulated = self.pos_arr_absolute_accumulated - self.pos_arr[0]
+        self.spectra_accumulated = accumulate_spectra(self.spectra, self.accumulation, out, chunk)
+        self.summary = summarize_spectra(self.spectra_accumulated, chunk)
+        self.band_intensity = {}
+
+    def integrate_band(self, start: int, stop: int) -> np.ndarray:
+        # 積算後の各スペクトルのstart画素目からstop画素目までの和．同じ範囲は計算し直さない
+        key = (start, stop)
+        if key not in self.band_intensity:
+            self.band_intensity[key] = self.spectra_accumulated[:, start:stop].sum(axis=1)
+        return self.band_intensity[key]
+
+
+def check_positions(pos_arr: np.ndarray, accumulation: int):
+    # 積算するスペクトルはすべてグループ先頭と同じ位置で取られているはず
+    pos_check = pos_arr[np.arange(pos_arr.shape[0]) // accumulation * accumulation]
+    different = np.flatnonzero(np.any(pos_arr != pos_check, axis=1))
+    if different.size > 0:
+        raise ValueError(f'Spectra were got at different positions: index {different.tolist()}')
+
+
+def get_grid_step(values: np.ndarray) -> float:
+    # 格子の間隔．ステージの位置のばらつきによる近い座標はひとつの列(行)にまとめ，隣り合う列の間隔のうち小さいものの中央値をとる
+    # まとめる範囲(ばらつきの大きさ)は，小さい順に並べた座標の差が大きく跳ぶところの手前の値を小さい方から試し，
+    # 列が等間隔の格子に乗る最初のものとする．最小の間隔の1.5倍を超える間隔(列の抜けや離れた領域)は間隔の計算に使わない
+    unique = np.unique(values)
+    if unique.size < 2:
+        return 1.0
+    diff = np.diff(unique)
+    sorted_diff = np.sort(diff)
+    tolerances = np.append(0, sorted_diff[:-1][sorted_diff[1:] >= sorted_diff[:-1] * 1.5])
+    step = 1.0
+    for tolerance in tolerances:
+        # 差がtolerance以下で続く座標をひとつの列とする
+        labels = np.append(0, np.cumsum(diff > tolerance))
+        first = np.flatnonzero(np.diff(labels, prepend=-1))
+        last = np.append(first[1:] - 1, unique.size - 1)
+        centers = np.add.reduceat(unique, first) / (last - first + 1)
+        spacing = np.diff(centers)
+        step = float(np.median(spacing[spacing <= spacing.min() * 1.5]))
+        # 隣との間隔から各列の番号を決め，番号と位置の直線の傾きを間隔とする(離れた領域まで誤差がたまらない)
+        num_steps = np.rint(spacing / step)
+        if np.any(num_steps < 1):
+            continue
+        k = np.append(0, np.cumsum(num_steps))
+        step, intercept = np.polyfit(k, centers, 1)
+        residual = centers - (intercept + step * k)
+        if (unique[last] - unique[first]).max() < step / 4 and np.all(np.abs(residual) < step / 4):
+            break
+    return float(step)
+
+
+def make_position_grid(pos_arr: np.ndarray) -> dict:
+    # 各位置のx, y座標を格子に並べる．index[行, 列]はその格子点のスペクトルの番号(なければ-1)
+    # 複数の位置が同じ格子点に入る場合は，クリックで選べないのでValueError
+    origin = pos_arr[:, :2].min(axis=0) if pos_arr.shape[0] > 0 else np.zeros(2)
+    step = np.array([get_grid_step(pos_arr[:, 0]), get_grid_step(pos_arr[:, 1])])
+    col, row = np.rint((pos_arr[:, :2] - origin) / step).astype(int).T
+    index = np.full([row.max() + 1 if row.size else 0, col.max() + 1 if col.size else 0], -1)
+    index[row, col] = np.arange(pos_arr.shape[0])
+    num_cells = np.count_nonzero(index >= 0)
+    if num_cells < pos_arr.shape[0]:
+        raise ValueError(f'Positions do not form a grid: {pos_arr.shape[0]} positions fall into {num_cells} grid points.')
+    return {'origin': origin, 'step': step, 'index': index, 'row': row, 'col': col}
+
+
+def accumulate_spectra(spectra: np.ndarray, accumulation: int, out: np.ndarray = None, chunk: int = None):
+    # 連続するaccumulation本ずつを足し合わせる．端数のスペクトルは捨てる
+    # chunkを指定すると，その位置数ずつ足し合わせてoutに書き込む(メモリマップ用)
+    # 和はfloat64で計算し，outの型(float32など)に丸めるのは最後の一回だけにする
+    num_pos = spectra.shape[0] // accumulation
+    num_pixel = spectra.shape[1]
+    if out is None:
+        out = np.empty([num_pos, num_pixel], dtype=spectra.dtype)
+    if chunk is None:
+        chunk = max(num_pos, 1)
+    for start in range(0, num_pos, chunk):
+        stop = min(start + chunk, num_pos)
+        block = spectra[start * accumulation:stop * accumulation].reshape([stop - start, accumulation, num_pixel])
+        if out.dtype == np.float64:
+            block.sum(axis=1, dtype=np.float64, out=out[start:stop])
+        else:
+            out[start:stop] = block.sum(axis=1, dtype=np.float64)
+    return out
+
+
+def summarize_spectra(spectra: np.ndarray, chunk: int = None):
+    # スペクトルごとの最小・最大・合計・ピーク位置(画素)
+    # 色の範囲を決めるたびにマップ全体を走査しないよう，読み込み時に一度だけ計算する
+    # chunkを指定すると，その行数ずつ計算する(メモリマップ用)
+    num_spectra = spectra.shape[0]
+    summary = {name: np.empty(num_spectra) for name in ['min', 'max', 'sum']}
+    summary['peak_index'] = np.empty(num_spectra, dtype=int)
+    if spectra.shape[1] == 0:
+        return summary
+    if chunk is None:
+        chunk = max(num_spectra, 1)
+    for start in range(0, num_spectra, chunk):
+        block = np.asarray(spectra[start:start + chunk])
+        rows = slice(start, start + block.shape[0])
+        summary['min'][rows] = block.min(axis=1)
+        summary['max'][rows] = block.max(axis=1)
+        summary['sum'][rows] = block.sum(axis=1)
+        summary['peak_index'][rows] = block.argmax(axis=1)
+    return summary
+
+
+def write_header(f, header: dict):
+    # スペクトルのデータを書き出す際，ファイルの最初のほうにメタデータを追加
+    for key, value in header.items():
+        f.write(f'# {key}: {value}\n')
+
+
+def format_rows(data: np.ndarray):
+    # np.ndarray.astype(str)と同じ表記(最短で元の値に戻る表記)でカンマ区切りの行にする
+    # ただしfloat32は有効数字9桁で書く．float32に読み込めば元の値に戻る(float64として書くと桁が増える)
+    if data.dtype == np.float32:
+        return [','.join(map('%.9g'.__mod__, row)) + '\n' for row in data.tolist()]
+    return [','.join(map(repr, row)) + '\n' for row in data.tolist()]
+
+
+def write_positions(f, pos_arr: np.ndarray):
+    for name, pos in zip(['pos_x', 'pos_y', 'pos_z'], pos_arr.T):
+        f.write(name + ',' + format_rows(pos[np.newaxis])[0])
+
+
+def write_map(f, xdata: np.ndarray, spectra: np.ndarray, pos_arr: np.ndarray, chunk_size: int = 64):
+    # 座標の3行と，波長ごとの行(波長, 各スペクトルの値)を書き出す
+    # マップ全体を文字列にするとメモリが足りなくなるので，chunk_size行ずつ変換して書き込む
+    write_positions(f, pos_arr)
+    for start in range(0, xdata.shape[0], chunk_size):
+        stop = start + chunk_size
+        if spectra.dtype == xdata.dtype:
+            f.writelines(format_rows(np.hstack([xdata[start:stop, np.newaxis], spectra[:, start:stop].T])))
+        else:
+            # 波長とスペクトルの型が違う場合は，それぞれの型で書いてつなげる
+            x_rows = format_rows(xdata[start:stop, np.newaxis])
+            f.writelines(x[:-1] + ',' + row for x, row in zip(x_rows, format_rows(spectra[:, start:stop].T)))
+
+
+def save_npz(filename: str, xdata: np.ndarray, spectra: np.ndarray, pos_arr: np.ndarray, header: dict):
+    # 他のツールから読みやすいよう，バイナリ(.npz)で保存する．ヘッダーはJSON文字列として保存
+    np.savez(filename, xdata=xdata, spectra=spectra, pos_arr=pos_arr,
+             header=np.array(json.dumps({key: str(value) for key, value in header.items()})))
+
+
+def load_npz(filename: str) -> FileReader:
+    # save_npzで保存したファイルを読む．ヘッダーの値は文字列で保存されているので型を戻す
+    reader = FileReader()
+    reader.filename = filename
+    with np.load(filename) as npz:
+        reader.xdata = npz['xdata']
+        reader.spectra = npz['spectra']
+        reader.pos_arr = npz['pos_arr']
+        header = json.loads(str(npz['header']))
+    reader.time = header['time']
+    reader.integration = float(header['integration'])
+    reader.accumulation = int(header['accumulation'])
+    reader.interval = float(header['interval'])
+    return reader
+
+
+def read_metadata(filename: str) -> FileReader:
+    # ヘッダーと座標のみ読む．スペクトルは読まない
+    reader = FileReader()
+    reader.filename = filename
+    with open(filename, 'r') as f:
+        header, reader.pos_arr = read_header(f)
+    reader.set_header(header)
+    return reader
+
+
+def check_metadata(readers: list):
+    # 同じ位置・同じ条件で測定したファイルでなければつなげられない
+    first = readers[0]
+    for reader in readers:
+        for name in ['integration', 'accumulation']:
+            if getattr(reader, name) != getattr(first, name):
+                raise ValueError(f'{name} does not match: {getattr(first, name)} ({first.filename}), '
+                                 f'{getattr(reader, name)} ({reader.filename})')
+        if reader.pos_arr.shape != first.pos_arr.shape or not np.array_equal(reader.pos_arr, first.pos_arr):
+            raise ValueError(f'Positions do not match: {first.filename}, {reader.filename}')
+        check_positions(reader.pos_arr, reader.accumulation)
+
+
+def concat(filenames, filename_to_save, chunk_size: int = 64):
+    # 波長範囲の異なる(同じ位置で測定した)マップを，波長方向につなげてひとつのファイルにする
+    # ファイル全体を読み込まず，chunk_size行(波長)ずつ読んで順に書き出す
+    readers = [read_metadata(filename) for filename in filenames]
+    check_metadata(readers)
+    first = readers[0]
+    num_columns = 1 + first.pos_arr.shape[0]
+
+    header = {
+        'abs_path_raw': ','.join(filenames),
+        'abs_path_bg': '',
+        'abs_path_ref': '',
+        'calibration': '',
+        'time': '',
+        'integration': first.integration,
+        'accumulation': first.accumulation,
+        'interval': first.interval,
+    }
+    # 途中で失敗した場合に中途半端なファイルを残さないよう，一時ファイルに書いてから置き換える
+    filename_tmp = f'{filename_to_save}.tmp'
+    try:
+        with open(filename_tmp, 'w') as f_save:
+            write_header(f_save, header)
+            write_positions(f_save, first.pos_arr)
+            for filename in filenames:
+                with open(filename, 'r') as f:
+                    read_header(f)
+                    for block in read_blocks(f, chunk_size):
+                        if block.shape[1] != num_columns:
+                            raise ValueError(f'Number of spectra does not match the positions: {filename}')
+                        f_save.writelines(format_rows(block))
+        os.replace(filename_tmp, filename_to_save)
+    except BaseException:
+        if os.path.exists(filename_tmp):
+            os.remove(filename_tmp)
+        raise
 
 
 if __name__ == '__main__':
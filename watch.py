@@ -0,0 +1,164 @@
+import os
+import re
+import sys
+import time
+import fnmatch
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from batch import process_job, make_job, add_job_arguments
+from RayleighCalibrator import RayleighCalibrator
+
+
+# ファイル名にこれらの語(大文字小文字は区別しない)を含むものはBG
+background_words = ['bg', 'background']
+
+
+class FolderWatcher:
+    # 測定中のフォルダを定期的に調べ，書き込みの終わった生データをbatchと同じ手順で別プロセスで処理する
+    # 参照・BGはファイル名から判定し，中心波長が同じもののうち最新のものを組み合わせる
+    def __init__(self, folder: str, args: argparse.Namespace, pattern: str = '*.txt', wait_ref: bool = True):
+        self.folder: str = folder
+        self.args = args
+        self.pattern: str = pattern
+        # 参照が見つかるまで生データの処理を待つかどうか．Falseなら校正せずに処理する
+        self.wait_ref: bool = wait_ref
+        # ファイル名から物質名と中心波長を推定するのに使う(MainWindow.after_drop_refと同じ)
+        self.calibrator = RayleighCalibrator()
+        # 前回調べた時の(大きさ, 更新時刻)．変わらなければ書き込みが終わったとみなす
+        self.stats: dict = {}
+        # 書き込みの終わったファイルの(種類, 中心波長, 更新時刻)
+        self.files: dict = {}
+        # 処理した(または失敗した)生データの(大きさ, 更新時刻)．ファイルが書き換えられたら処理し直す
+        self.done: dict = {}
+        # 処理中の生データ
+        self.running: dict = {}
+        # 参照・BG待ちの生データ．同じメッセージを繰り返し表示しないため
+        self.waiting: set = set()
+
+    def classify(self, filename: str) -> tuple:
+        # (種類, 中心波長)．物質名を含むものは参照，background_wordsを含むものはBG，それ以外は生データ
+        name = os.path.basename(filename)
+        material, center = self.calibrator.guess_reference_settings(name)
+        if material is not None:
+            return 'ref', center
+        if set(re.split(r'[^a-z0-9]+', name.lower())) & set(background_words):
+            return 'bg', center
+        return 'raw', center
+
+    def get_output(self, filename: str) -> str:
+        name = os.path.splitext(os.path.basename(filename))[0]
+        return os.path.join(self.args.output, f'{name}{self.args.suffix}.{self.args.format}')
+
+    def is_output(self, filename: str) -> bool:
+        # 出力先が監視するフォルダと同じ場合，処理結果を生データとして拾わない
+        return os.path.splitext(os.path.basename(filename))[0].endswith(self.args.suffix)
+
+    def scan(self, settle: bool = True) -> None:
+        # settleの場合，前回から大きさと更新時刻の変わらなかったファイルだけを書き込み済みとする
+        stats = {}
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                if not entry.is_file() or not fnmatch.fnmatch(entry.name, self.pattern) or self.is_output(entry.path):
+                    continue
+                stat = entry.stat()
+                stats[entry.path] = (stat.st_size, stat.st_mtime_ns)
+        for filename, stat in stats.items():
+            if not settle or self.stats.get(filename) == stat:
+                self.files[filename] = (*self.classify(filename), stat[1])
+            else:
+                # 書き込み済みだったファイルが書き換えられている．また変わらなくなるまで使わない
+                self.files.pop(filename, None)
+        self.files = {filename: info for filename, info in self.files.items() if filename in stats}
+        self.stats = stats
+
+    def find(self, kind: str, center: float) -> str:
+        # 中心波長が同じもののうち最新のもの．生データの中心波長がわからなければ種類の同じもののうち最新のもの
+        # 中心波長の異なる(別の窓の)ファイルは使わない
+        candidates = [(mtime, filename) for filename, (k, c, mtime) in self.files.items()
+                      if k == kind and (center is None or c == center)]
+        if not candidates and center is not None:
+            candidates = [(mtime, filename) for filename, (k, c, mtime) in self.files.items() if k == kind and c is None]
+        return max(candidates)[1] if candidates else None
+
+    def make_job(self, filename: str, center: float) -> dict:
+        # 参照・BGが足りなければNone．--ref, --bgを指定した場合はそちらを使う
+        row = {'raw': filename}
+        if self.args.ref is None:
+            row['ref'] = self.find('ref', center)
+            if row['ref'] is None and self.wait_ref:
+                return None
+        if self.args.bg is None:
+            row['bg'] = self.find('bg', center)
+            if row['bg'] is None and self.args.background:
+                return None
+        return make_job(row, self.args)
+
+    def is_processed(self, filename: str) -> bool:
+        # 前回起動した時に処理したものは，出力の方が新しければ処理し直さない
+        if self.done.get(filename) == self.stats[filename]:
+            return True
+        output = self.get_output(filename)
+        return os.path.exists(output) and os.path.getmtime(output) >= os.path.getmtime(filename)
+
+    def submit(self, executor: ProcessPoolExecutor) -> None:
+        for filename, (kind, center, _) in sorted(self.files.items(), key=lambda item: item[1][2]):
+            if kind != 'raw' or filename in self.running or self.is_processed(filename):
+                continue
+            job = self.make_job(filename, center)
+            if job is None:
+                if filename not in self.waiting:
+                    print(f'{filename}: waiting for the reference or background data')
+                    self.waiting.add(filename)
+                continue
+            self.waiting.discard(filename)
+            print(f'{filename}: processing (bg: {job["bg"]}, ref: {job["ref"]})')
+            self.running[filename] = (executor.submit(process_job, job), self.stats[filename])
+
+    def collect(self) -> None:
+        for filename, (future, stat) in list(self.running.items()):
+            if not future.done():
+                continue
+            del self.running[filename]
+            self.done[filename] = stat
+            try:
+                print(f'{filename} -> {future.result()}')
+            except Exception as e:
+                print(f'{filename}: {e}', file=sys.stderr)
+
+    def run(self, interval: float = 5, workers: int = 1, once: bool = False) -> None:
+        # onceの場合，今あるファイルを処理して終わる
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            while True:
+                self.scan(settle=not once)
+                self.collect()
+                self.submit(executor)
+                if once and not self.running:
+                    break
+                time.sleep(0.1 if once else interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Watch a folder and process RAS map files as they are written.')
+    parser.add_argument('folder', help='folder the acquisition software writes to')
+    parser.add_argument('--pattern', default='*.txt', help='file name pattern of the map files')
+    parser.add_argument('--interval', type=float, default=5, help='seconds between scans of the folder')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes (one map per process)')
+    parser.add_argument('--no-ref', action='store_true', help='process maps without calibration if no reference is found')
+    parser.add_argument('--once', action='store_true', help='process the files already in the folder and exit')
+    add_job_arguments(parser)
+    parser.add_argument('--no-preview', dest='preview', action='store_false', help='do not save PNG images')
+    parser.set_defaults(output=None, preview=True)
+    args = parser.parse_args()
+    if args.output is None:
+        args.output = os.path.join(args.folder, 'processed')
+
+    watcher = FolderWatcher(args.folder, args, args.pattern, wait_ref=not args.no_ref)
+    print(f'Watching {os.path.abspath(args.folder)} (Ctrl+C to stop)')
+    try:
+        watcher.run(args.interval, args.workers, args.once)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
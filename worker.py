@@ -0,0 +1,104 @@
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Cancelled(Exception):
+    pass
+
+
+class Task:
+    # Workerで実行中の処理．処理の区切りでprogressを呼ぶと，取り消されていればCancelledを投げる
+    def __init__(self, stage: str, messages: queue.Queue):
+        self.stage: str = stage
+        self.messages: queue.Queue = messages
+        self.cancel_event = threading.Event()
+
+    def cancel(self) -> None:
+        self.cancel_event.set()
+
+    def is_cancelled(self) -> bool:
+        return self.cancel_event.is_set()
+
+    def progress(self, fraction: float, message: str = '') -> None:
+        if self.is_cancelled():
+            raise Cancelled()
+        self.messages.put((self, 'progress', (fraction, message)))
+
+
+class Worker:
+    # 重い処理をTkのメインループとは別のスレッドで順番に実行する
+    # 結果や進捗はキューに入れ，メインスレッドがafter()で定期的に取り出してコールバックを呼ぶ
+    # 同じstageの処理を新しく投入すると，古い処理は取り消され，結果も捨てられる
+    def __init__(self, master, interval: int = 50):
+        self.master = master
+        self.interval: int = interval
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.messages: queue.Queue = queue.Queue()
+        self.tasks: dict = {}  # stageごとの最新のTask
+        self.callbacks: dict = {}
+        self.polling: bool = False
+
+    def submit(self, stage: str, func, on_done=None, on_error=None, on_progress=None) -> Task:
+        # funcはTaskを引数にとる．on_done(結果), on_error(例外), on_progress(割合, メッセージ)はメインスレッドで呼ばれる
+        if stage in self.tasks:
+            self.tasks[stage].cancel()
+        task = Task(stage, self.messages)
+        self.tasks[stage] = task
+        self.callbacks[task] = (on_done, on_error, on_progress)
+        self.executor.submit(self.run, task, func)
+        if not self.polling:
+            self.polling = True
+            self.master.after(self.interval, self.poll)
+        return task
+
+    def run(self, task: Task, func) -> None:
+        if task.is_cancelled():
+            self.messages.put((task, 'cancelled', None))
+            return
+        try:
+            result = func(task)
+        except Cancelled:
+            self.messages.put((task, 'cancelled', None))
+        except Exception as e:
+            self.messages.put((task, 'error', e))
+        else:
+            self.messages.put((task, 'done', result))
+
+    def poll(self) -> None:
+        while True:
+            try:
+                task, kind, value = self.messages.get_nowait()
+            except queue.Empty:
+                break
+            on_done, on_error, on_progress = self.callbacks.get(task, (None, None, None))
+            if kind == 'progress':
+                if not task.is_cancelled() and on_progress is not None:
+                    on_progress(*value)
+                continue
+            # 終わった処理の後始末．取り消された(より新しい処理がある)場合は結果を使わない
+            self.callbacks.pop(task, None)
+            if self.tasks.get(task.stage) is task:
+                del self.tasks[task.stage]
+            if task.is_cancelled():
+                continue
+            if kind == 'done' and on_done is not None:
+                on_done(value)
+            elif kind == 'error' and on_error is not None:
+                on_error(value)
+
+        if self.callbacks:
+            self.master.after(self.interval, self.poll)
+        else:
+            self.polling = False
+
+    def is_busy(self) -> bool:
+        return bool(self.tasks)
+
+    def cancel(self) -> None:
+        for task in self.tasks.values():
+            task.cancel()
+
+    def shutdown(self) -> None:
+        self.cancel()
+        self.executor.shutdown(wait=False)